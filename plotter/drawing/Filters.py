@@ -3,6 +3,82 @@ try:
     HAS_SCIPY = True
 except ImportError:
     HAS_SCIPY = False
+from multiprocessing.pool import ThreadPool
+import inspect
+from collections import OrderedDict
+import numpy as np
+
+
+class ScaleSpace(object):
+    """
+    Cache of Gaussian blurs of a single image, so that filters working
+    at the same scales can share them. Blurs are computed in float32,
+    and the least recently used ones are dropped beyond max_blurs.
+    Filters accept a ScaleSpace wherever they take an image.
+    """
+
+    def __init__(self, image, incremental=False, workers=4, max_blurs=6):
+        """
+        image:       The image to blur.
+        incremental: Compute each blur from the closest smaller sigma
+                     already available, which is cheaper for large
+                     sigmas but serializes the work.
+        workers:     Number of threads for computing independent blurs.
+        max_blurs:   Number of blurs to keep, each taking four bytes
+                     per pixel.
+        """
+        if not HAS_SCIPY:
+            raise RuntimeError('This operation requires scipy.')
+        self.image = np.asarray(image, dtype=np.float32)
+        self.incremental = incremental
+        self.workers = workers
+        self.max_blurs = max_blurs
+        self._cache = OrderedDict([(0, self.image)])
+
+    def blur(self, sigma):
+        """
+        Returns the image blurred with a Gaussian of width sigma.
+        """
+        return self.blurs([sigma])[0]
+
+    def blurs(self, sigmas):
+        """
+        Returns a list of blurred images, one for each sigma in sigmas.
+        Missing blurs are computed in parallel unless incremental.
+        """
+        missing = sorted(set(sigmas) - set(self._cache.keys()))
+        if self.incremental:
+            for sigma in missing:
+                self._cache[sigma] = self._compute(sigma)
+        elif len(missing) > 1 and self.workers > 1:
+            pool = ThreadPool(min(len(missing), self.workers))
+            try:
+                results = pool.map(self._compute, missing)
+            finally:
+                pool.close()
+            self._cache.update(zip(missing, results))
+        else:
+            for sigma in missing:
+                self._cache[sigma] = self._compute(sigma)
+        result = [self._cache[sigma] for sigma in sigmas]
+
+        # mark as recently used, and drop the oldest blurs but never
+        # the image itself
+        for sigma in sigmas:
+            self._cache[sigma] = self._cache.pop(sigma)
+        blurs = [s for s in self._cache.keys() if s != 0]
+        for sigma in blurs[:max(len(blurs) - self.max_blurs, 0)]:
+            del self._cache[sigma]
+        return result
+
+    def _compute(self, sigma):
+        if self.incremental:
+            # blurring with s1 and then s2 equals blurring with
+            # sqrt(s1**2 + s2**2)
+            base = max(s for s in self._cache.keys() if s < sigma)
+            return ndimage.filters.gaussian_filter(
+                self._cache[base], np.sqrt(sigma**2 - base**2))
+        return ndimage.filters.gaussian_filter(self.image, sigma)
 
 
 def filter_lookup(filter_name):
@@ -12,12 +88,33 @@ def filter_lookup(filter_name):
         print "No filter named", filter_name
 
 
+def filter_sigmas(filter_name, filter_kwargs):
+    """
+    Returns the blur widths a filter takes from its ScaleSpace, so that
+    those of several filters can be computed together. Filters name
+    their blur width arguments in a sigma_args attribute.
+    """
+    filter_func = filter_lookup(filter_name)
+    names = getattr(filter_func, 'sigma_args', ())
+    if not names:
+        return []
+    spec = inspect.getargspec(filter_func)
+    defaults = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+    return [filter_kwargs.get(name, defaults[name]) for name in names]
+
+
 def difference_of_gaussians(image, larger_filter_size=5, smaller_filter_size=3,
                             threshold=0):
         if not HAS_SCIPY:
             raise RuntimeError('This operation requires scipy.')
-        image_small_filter = ndimage.filters.gaussian_filter(image, larger_filter_size)
-        image_large_filter = ndimage.filters.gaussian_filter(image, smaller_filter_size)
+        if not isinstance(image, ScaleSpace):
+            image = ScaleSpace(image)
+        image_small_filter, image_large_filter = image.blurs(
+            [larger_filter_size, smaller_filter_size])
         difference_image = image_large_filter - image_small_filter
         thresholded_image = difference_image > threshold
         return thresholded_image
+
+
+difference_of_gaussians.sigma_args = ('larger_filter_size',
+                                      'smaller_filter_size')
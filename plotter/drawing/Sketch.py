@@ -10,7 +10,15 @@ try:
     HAS_SKIM = True
 except ImportError:
     HAS_SKIM = False
+try:
+    import scipy.ndimage as ndimage
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
 import time
+import struct
+import multiprocessing
+from collections import OrderedDict
 
 from .Trajectory import Trajectory
 from . import Filters
@@ -22,46 +30,127 @@ class Sketch(object):
     drawing trajectories in various ways.
     """
 
-    def __init__(self, image=None, max_size=None):
+    def __init__(self, image=None, max_size=None, cache_size=16):
         """
         Constructor.
 
         image: Filename, function that returns an ndarray image, or just
                an ndarray.
+        cache_size: Number of intermediate results (filter masks,
+               skeletons, binned images etc) to keep, so that repeated
+               calls with partly changed parameters only recompute
+               the stages that depend on the change.
         """
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
         if image is not None:
             self.read_image(image, max_size)
 
+    @property
+    def image(self):
+        return self._image
+
+    @image.setter
+    def image(self, val):
+        # cached results refer to the old image
+        self._image = val
+        self._cache.clear()
+
+    def _memoize(self, key, func, *args):
+        """
+        Returns func(*args), computed only if key isn't in the cache.
+        The least recently used results are dropped from the cache.
+        """
+        try:
+            value = self._cache.pop(key)
+        except KeyError:
+            value = func(*args)
+        self._cache[key] = value
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def _binned(self, m, n):
+        """
+        Memoized utils.bin_pixels of the current image.
+        """
+        return self._memoize(('binned', m, n), utils.bin_pixels,
+                             self.image, m, n)
+
     def read_image(self, image, max_size=None):
+        """
+        Loads image as 8 bit grayscale, scaled down to max_size pixels
+        along its longest side if given. Files are decoded directly to
+        grayscale, and JPEGs at the smallest reduced scale (1/2, 1/4 or
+        1/8) that is still at least max_size large.
+
+        NPY files and memory-mapped arrays are kept memory-mapped, and
+        used as they are without resizing.
+        """
+        if type(image) == str and image.lower().endswith('.npy'):
+            image = np.load(image, mmap_mode='r')
+        if isinstance(image, np.memmap):
+            # memory-mapped images are used as they are, without
+            # loading them for conversion or resizing
+            if image.ndim != 2 or image.dtype != np.uint8:
+                raise ValueError('memory-mapped images must be 8 bit '
+                                 'grayscale')
+            self.image = image
+            return
+
         if not HAS_CV2:
             raise RuntimeError('OpenCV needed for this operation')
         if type(image) == str:
-            self.image = cv2.cvtColor(
-                cv2.imread(image, cv2.IMREAD_UNCHANGED),
-                cv2.COLOR_BGR2RGB)
-        elif type(image) == np.ndarray:
-            self.image = image
+            image = _imread_gray(image, max_size)
         elif hasattr(image, '__call__'):
-            self.image = image()
+            image = image()
 
-        # make sure image is grayscale
-        while len(self.image.shape) > 2:
-            self.image = np.mean(self.image, axis=-1)
+        # make sure image is grayscale, using integer luminance for
+        # 8 bit color images
+        if image.ndim == 3 and image.dtype == np.uint8 and \
+                image.shape[-1] in (3, 4):
+            code = {3: cv2.COLOR_RGB2GRAY, 4: cv2.COLOR_RGBA2GRAY}
+            image = cv2.cvtColor(image, code[image.shape[-1]])
+        while len(image.shape) > 2:
+            image = np.mean(image, axis=-1)
 
         # make sure image is 8 bit
-        self.image = self.image.astype(np.uint8)
+        if image.dtype != np.uint8:
+            image = image.astype(np.uint8)
 
         # resize image
         if max_size is not None:
-            scale = float(max_size) / np.max(self.image.shape)
-            self.image = cv2.resize(self.image, (0, 0), fx=scale, fy=scale)
+            scale = float(max_size) / np.max(image.shape)
+            image = cv2.resize(image, (0, 0), fx=scale, fy=scale)
+        self.image = image
+
+    def read_raw(self, filename, shape, dtype=np.uint8, offset=0):
+        """
+        Memory-maps a raw 8 bit grayscale image file of the given
+        (rows, columns) shape, for images too large to load. Raster
+        lines can then be generated with iter_amplitude_mod_scan.
+        """
+        self.read_image(np.memmap(filename, dtype=dtype, mode='r',
+                                  offset=offset, shape=shape))
 
     def amplitude_mod_scan(self, n_lines, pixels_per_period, gain=1,
-                           waveform='square', snake_scan=True):
+                           waveform='square', snake_scan=True,
+                           continuous=False, skip_below=None, min_skip=20):
         """
         Returns line scan Trajectory for the current image with darkness
         modulated as amtlitude.
+
+        continuous: Join the lines of the snake scan into a single path,
+                    so that the whole scan is drawn without pen lifts.
+
+        skip_below: If given, stretches of the lines where the darkness
+                    (0 to 1) stays below this value are left out, so
+                    that they become fast pen-up travel instead.
+
+        min_skip: Blank stretches shorter than this many pixels are
+                  drawn anyway, to avoid pointless pen lifts.
         """
+        self._check_continuous(snake_scan, continuous)
         assert waveform in ['square', 'sawtooth']
         try:
             assert pixels_per_period % 2 == 0
@@ -70,76 +159,204 @@ class Sketch(object):
             raise ValueError('pixelsPerPerdiod must be even')
 
         linewidth = self.image.shape[0] / n_lines
-        binnedImage = utils.bin_pixels(self.image, m=linewidth, n=pixels_per_half_period)
+        binnedImage = self._binned(linewidth, pixels_per_half_period)
+        centers = linewidth * np.arange(n_lines) + linewidth / 2
+        x, y, blank = self._amplitude_lines(
+            binnedImage[:n_lines], n_lines * linewidth, centers, linewidth,
+            pixels_per_half_period, gain, waveform, skip_below)
+
         lines = Trajectory()
-        for line in range(n_lines):
-            # j is the horizontal pixel index, one for each horizontal step
-            j = np.arange(binnedImage.shape[1]) * pixels_per_half_period
-            # the darkness per stop of this particular line
-            lineIntensity = (255.0 - binnedImage[line]) / 255.0
-            # basic sawtooth waveform
-            i = np.arange(binnedImage.shape[1], dtype=float)
-            i = (i % 2) * 2 - 1
-            # scale the waveform
-            i *= gain * lineIntensity * linewidth / 2.0
-            # add the row offset
-            i += (linewidth * line + linewidth / 2)
-            # convert to cartesian coordinates
-            xy = np.vstack((j, n_lines * linewidth - i)).T
-            lines.append(xy)
+        lines.append_packed(np.dstack((x, y)))
+        # a segment is blank if both its ends are
+        blank = list(blank[:, :-1] & blank[:, 1:])[:len(lines)]
+
+        return self._finish_scan(lines, blank, snake_scan, continuous,
+                                 skip_below, min_skip)
+
+    def iter_amplitude_mod_scan(self, n_lines, pixels_per_period, gain=1,
+                                waveform='square', snake_scan=True):
+        """
+        Generates the lines of amplitude_mod_scan one at a time, as
+        (N, 2) arrays in image coordinates. Only the band of image rows
+        under the current line is read, so that memory-mapped images
+        (see read_image and read_raw) larger than the available memory
+        can be scanned.
+        """
+        assert waveform in ['square', 'sawtooth']
+        try:
+            assert pixels_per_period % 2 == 0
+            pixels_per_half_period = pixels_per_period / 2
+        except AssertionError:
+            raise ValueError('pixelsPerPerdiod must be even')
+
+        linewidth = self.image.shape[0] / n_lines
+        for k in range(n_lines):
+            band = np.asarray(self.image[k * linewidth:(k + 1) * linewidth])
+            binned = utils.bin_pixels(band, linewidth, pixels_per_half_period)
+            x, y, _ = self._amplitude_lines(
+                binned, n_lines * linewidth, linewidth * k + linewidth / 2,
+                linewidth, pixels_per_half_period, gain, waveform)
+            line = np.vstack((x[0], y[0])).T
+            if snake_scan and k % 2:
+                line = np.flipud(line)
+            yield line
+
+    def _amplitude_lines(self, binned, height, centers, heights,
+                         pixels_per_half_period, gain, waveform,
+                         skip_below=None):
+        """
+        Computes the amplitude modulated lines for the rows of a binned
+        image, centered on the image rows centers and with the full
+        amplitude heights, either one value per line or one for all.
+        Returns x and y, one row per line, and the blank stop flags.
+        """
+        n_lines = binned.shape[0]
+        centers = np.broadcast_to(centers, (n_lines,))
+        heights = np.broadcast_to(heights, (n_lines,))
+        # all lines at once, one row per line
+        # j is the horizontal pixel index, one for each horizontal step
+        j = np.arange(binned.shape[1]) * pixels_per_half_period
+        # the darkness per stop of each line
+        intensity = (255.0 - binned) / 255.0
+        # basic sawtooth waveform
+        i = np.arange(binned.shape[1], dtype=float)
+        i = (i % 2) * 2 - 1
+        # scale the waveform
+        i = i * gain * intensity * heights[:, None] / 2.0
+        # add the row offsets
+        i += centers[:, None]
+        # convert to cartesian coordinates
+        x = np.tile(j.astype(float), (n_lines, 1))
+        y = height - i
+
+        # blank stops, one per point like the y values
+        blank = intensity < (skip_below or 0)
 
         if waveform == 'square':
-            # for each line, convert the sawtooth to a square by adding points
-            # there's an extra zero somewhere but it works.
-            for i in range(lines.number):
-                x = lines[i][:, 0]
-                y = lines[i][:, 1]
-                xx = np.zeros(x.size * 2)
-                yy = np.zeros(y.size * 2)
-                xx[0::2] = x
-                xx[1::2] = x
-                yy[0::2] = y
-                yy[1:-1:2] = y[1:]
-                lines[i] = np.vstack((xx, yy)).T
+            # convert the sawtooth to a square by repeating every x
+            # and shifting the repeated y values one step back
+            x = np.repeat(x, 2, axis=1)[:, :-1]
+            y = np.repeat(y, 2, axis=1)[:, 1:]
+            blank = np.repeat(blank, 2, axis=1)[:, 1:]
+        return x, y, blank
+
+    def adaptive_mod_scan(self, n_lines, pixels_per_period, gain=1,
+                          min_density=0.25, waveform='square',
+                          snake_scan=True, continuous=False,
+                          skip_below=None, min_skip=20):
+        """
+        Returns line scan Trajectory like amplitude_mod_scan, but with
+        the line spacing chosen per band from the local darkness, so
+        that light regions get fewer lines and the whole plot is
+        shorter for the same visual density.
 
-        if snake_scan:
-            self._make_snake_scan(lines)
+        n_lines: number of lines for an image that is dark all over
 
-        return lines
+        min_density: line density in the lightest bands, as a fraction
+                     of the density in the darkest
+        """
+        self._check_continuous(snake_scan, continuous)
+        assert waveform in ['square', 'sawtooth']
+        try:
+            assert pixels_per_period % 2 == 0
+            pixels_per_half_period = pixels_per_period / 2
+        except AssertionError:
+            raise ValueError('pixelsPerPerdiod must be even')
+        h = self.image.shape[0]
+        assert n_lines <= h
+
+        # row darkness profile, from the darker parts of each row and
+        # smoothed over about one uniform line width
+        darkness = np.percentile(255.0 - self.image, 90, axis=1)
+        box = np.ones(max(h // n_lines, 1))
+        darkness = np.convolve(darkness, box / box.size, mode='same')
+        density = np.maximum(darkness / max(darkness.max(), 1e-9), min_density)
+
+        # place the lines at equal steps of the cumulative density, and
+        # let each one cover the band halfway to its neighbours
+        cumulative = np.cumsum(density)
+        number = max(int(round(cumulative[-1] * n_lines / float(h))), 1)
+        centers = np.interp((np.arange(number) + .5) / number * cumulative[-1],
+                            cumulative, np.arange(h) + .5)
+        edges = np.round(np.hstack((0, (centers[1:] + centers[:-1]) / 2, h)))
+        edges = edges.astype(int)
+        heights = np.diff(edges)
+
+        # band means for every stop along every line
+        columns = utils.bin_pixels(self.image.astype(np.float64), 1,
+                                   pixels_per_half_period)
+        sums = np.add.reduceat(columns[:edges[-1]], edges[:-1], axis=0)
+        x, y, blank = self._amplitude_lines(
+            sums / heights[:, None], h, centers, heights,
+            pixels_per_half_period, gain, waveform, skip_below)
+
+        lines = Trajectory()
+        lines.append_packed(np.dstack((x, y)))
+        # a segment is blank if both its ends are
+        blank = list(blank[:, :-1] & blank[:, 1:])[:len(lines)]
+
+        return self._finish_scan(lines, blank, snake_scan, continuous,
+                                 skip_below, min_skip)
 
     def frequency_mod_scan(self, n_lines, pixels_per_typical_period, gain=1,
-                           waveform='square', snake_scan=True):
+                           waveform='square', snake_scan=True,
+                           continuous=False, skip_below=None, min_skip=20):
         """
         Returns line scan Trajectory for the current image with darkness
         modulated as frequency.
 
         pixels_per_typical_period: the frequency at image value 255 / 2.0
+
+        continuous: Join the lines of the snake scan into a single path,
+                    so that the whole scan is drawn without pen lifts.
+
+        skip_below: If given, stretches of the lines where the darkness
+                    (0 to 1) stays below this value are left out, so
+                    that they become fast pen-up travel instead.
+
+        min_skip: Blank stretches shorter than this many pixels are
+                  drawn anyway, to avoid pointless pen lifts.
         """
+        self._check_continuous(snake_scan, continuous)
         assert waveform in ['square', 'sawtooth']
         linewidth = self.image.shape[0] / n_lines
-        binnedImage = utils.bin_pixels(self.image, m=linewidth, n=1)
+        binnedImage = self._binned(linewidth, 1)
+
+        # accumulated pixel intensity where the waveform changes value
+        accThreshold = 1.0 / 2 * pixels_per_typical_period
+        # flip the waveform wherever the darkness accumulated along the
+        # line since the last flip exceeds the threshold
+        darkness = 255 - binnedImage[:n_lines].astype(np.int64)
+        flips = _reset_crossings(darkness, accThreshold)
+
+        # total darkness up to each column, for the blank test
+        cumsum = np.cumsum(darkness, axis=1)
 
         lines = Trajectory()
+        blank = []
         for line in range(n_lines):
-            # the average darkness per pixel column of this particular line
-            lineIntensity = (255.0 - binnedImage[line]) / 255.0
-            # accumulated pixel intensity where the waveform changes value
-            accThreshold = 1.0 / 2 * pixels_per_typical_period
-            # now run through the row and flip the waveform when appropriate
-            i, j = [-1, ], [0, ]
-            acc = lineIntensity[0]
-            for ii in range(1, len(lineIntensity)):
-                acc += lineIntensity[ii]
-                if acc > accThreshold:
-                    if waveform == 'square':
-                        j += [ii, ii]
-                        i += [i[-1], -1*i[-1]]
-                    elif waveform == 'sawtooth':
-                        j += [ii]
-                        i += [-1*i[-1]]
-                    acc = 0
+            # the waveform starts at -1 and changes sign at every flip
+            f = flips[line]
+            if not len(f):
+                continue
+            sign = -(-1.0) ** np.arange(len(f) + 1)
+            # stretches between flips are blank if their mean darkness is
+            # below skip_below
+            stops = np.hstack((0, f))
+            dark = np.diff(cumsum[line][stops])
+            flat = dark < (skip_below or 0) * 255 * np.diff(stops)
+            if waveform == 'square':
+                j = np.hstack((0, np.repeat(f, 2)))
+                i = np.repeat(sign, 2)[:-1]
+                # the steps at the flips are blank between blank stretches
+                seg = np.zeros(2 * len(flat), dtype=bool)
+                seg[0::2] = flat
+                seg[1::2] = flat & np.append(flat[1:], True)
+            elif waveform == 'sawtooth':
+                j = stops
+                i = sign
+                seg = flat
             j = np.array(j, dtype=float)
-            i = np.array(i, dtype=float)
             # scale the waveform
             i *= gain * linewidth / 2.0
             # add the row offset
@@ -147,11 +364,81 @@ class Sketch(object):
             # convert to cartesian coordinates
             xy = np.vstack((j, n_lines * linewidth - i)).T
             lines.append(xy)
+            blank.append(seg)
 
-        if snake_scan:
-            self._make_snake_scan(lines)
+        return self._finish_scan(lines, blank, snake_scan, continuous,
+                                 skip_below, min_skip)
 
-        return lines
+    def spiral_mod_scan(self, n_turns, pixels_per_period, gain=1,
+                        waveform='square', modulation='amplitude'):
+        """
+        Returns a Trajectory with a single path, an Archimedean spiral
+        from the center of the current image outwards, with darkness
+        modulated as amplitude or frequency like the line scans. Draws
+        without any pen lifts.
+
+        n_turns: number of turns out to the edge of the largest
+                 circle that fits in the image
+
+        pixels_per_period: the modulation period for amplitude, and
+                           the period at image value 255 / 2.0 for
+                           frequency modulation
+        """
+        assert waveform in ['square', 'sawtooth']
+        assert modulation in ['amplitude', 'frequency']
+        if not HAS_SCIPY:
+            raise RuntimeError('This operation requires scipy.')
+        h, w = self.image.shape
+        spacing = min(h, w) / 2.0 / n_turns
+        # r = a * theta, sampled at roughly equal arc length steps
+        a = spacing / (2 * np.pi)
+        length = a * (2 * np.pi * n_turns)**2 / 2
+        if modulation == 'amplitude':
+            step = pixels_per_period / 2.0
+        else:
+            step = 1.0
+        theta = np.sqrt(2 * np.arange(0, length, step) / a)
+        r = a * theta
+
+        # the darkness along the spiral, averaged over about one turn
+        blurred = self._scale_space().blur(spacing / 2.0)
+        rows = h / 2.0 - r * np.sin(theta)
+        cols = w / 2.0 + r * np.cos(theta)
+        intensity = (255.0 - ndimage.map_coordinates(
+            blurred, [rows, cols], order=1, mode='nearest')) / 255.0
+
+        if modulation == 'amplitude':
+            # basic sawtooth waveform, scaled by the darkness
+            wave = (np.arange(len(theta)) % 2) * 2 - 1.0
+            wave *= intensity
+            if waveform == 'square':
+                # radial steps at every sample, as in amplitude_mod_scan
+                theta = np.repeat(theta, 2)[:-1]
+                r = np.repeat(r, 2)[:-1]
+                wave = np.repeat(wave, 2)[1:]
+        else:
+            # flip the waveform where the accumulated darkness is enough
+            darkness = np.round(255 * intensity).astype(np.int64)[None]
+            flips = _reset_crossings(darkness, pixels_per_period / 2.0)[0]
+            signs = -(-1.0) ** np.arange(len(flips) + 1)
+            index = np.arange(len(theta))
+            if waveform == 'square':
+                # constant between flips, with a radial step at each
+                wave = signs[np.searchsorted(flips, index, side='right')]
+                theta = np.insert(theta, flips, theta[flips])
+                r = np.insert(r, flips, r[flips])
+                wave = np.insert(wave, flips, signs[:-1])
+            elif waveform == 'sawtooth':
+                # straight ramps from flip to flip along the spiral
+                wave = np.interp(index, np.hstack((0, flips)), signs)
+
+        # scale the waveform and convert to cartesian coordinates
+        r = r + wave * gain * spacing / 2.0
+        xy = np.vstack((w / 2.0 + r * np.cos(theta),
+                        h - (h / 2.0 - r * np.sin(theta)))).T
+        traj = Trajectory()
+        traj.append(xy)
+        return traj
 
     def contour_drawing(self,
                         filter_list=[{"difference_of_gaussians": {
@@ -161,7 +448,8 @@ class Sketch(object):
                                }
                                     }],
                         min_blob_size=100,
-                        smooth=False, **kwargs):
+                        smooth=False, engine='skeleton', tile_size=None,
+                        halo=32, processes=None, **kwargs):
         """
         Makes a pencil drawing of the image, returned as a Trajectory.
         We find ridges by a difference-of-Gaussians filter
@@ -175,87 +463,472 @@ class Sketch(object):
 
         smooth: Whether to smooth the drawing to lose pixel steps
 
+        engine: 'skeleton' traces the center lines of the filtered edges,
+                'outline' traces their closed outlines, which is much
+                cheaper and often good enough.
+
+        tile_size: If given, split the image into square tiles of this
+                   many pixels and process them in parallel, which
+                   pays off for large images. Strokes crossing tile
+                   borders are joined again afterwards.
+
+        halo: Overlap in pixels added around each tile, should cover
+              the reach of the filters.
+
+        processes: Number of worker processes for tiles, defaults to
+                   the number of cores.
+
         **kwargs: passed to scipy.signal.savgol_filter through Trajectory.smooth
         """
-        if not HAS_SKIM:
-            raise "skimage needed for this operation"
+        assert engine in ['skeleton', 'outline']
+        if engine == 'skeleton' and not HAS_SKIM:
+            raise RuntimeError('skimage needed for this operation')
+
+        # each stage is memoized on the parameters of all stages up to
+        # and including itself
+        mask_key = ('mask', _freeze(filter_list))
+        if tile_size:
+            trace_key = ('tiled_trace', _freeze(filter_list), min_blob_size,
+                         engine, tile_size, halo)
+            traj = self._memoize(trace_key, self._trace_tiled, filter_list,
+                                 min_blob_size, engine, tile_size, halo,
+                                 processes)
+        else:
+            trace_key = ('trace', mask_key, min_blob_size, engine)
+            traj = self._memoize(trace_key, self._trace, mask_key,
+                                 filter_list, min_blob_size, engine)
+
+        # smooth
+        if smooth:
+            traj = self._memoize(('smooth', trace_key, _freeze(kwargs)),
+                                 self._smooth, traj, kwargs)
+
+        return traj.copy()
+
+    def _scale_space(self):
+        """
+        The scale space is shared by all filter masks of an image, so
+        that a sweep over filter parameters can reuse the blurs.
+        """
+        return self._memoize(('scale_space',), Filters.ScaleSpace, self.image)
 
-        image = self.image.astype(np.float64)
+    def _filter_mask(self, filter_list):
+        image = self._scale_space()
+        # compute the blurs of all filters at once, so that they can
+        # run in parallel, if the scale space can hold them all
+        sigmas = []
+        for filter_descriptor in filter_list:
+            for filter_name, filter_kwargs in filter_descriptor.iteritems():
+                sigmas += Filters.filter_sigmas(filter_name, filter_kwargs)
+        if len(set(sigmas)) <= image.max_blurs:
+            image.blurs(sigmas)
 
-        mask = np.zeros(shape=image.shape, dtype=np.bool)
+        mask = np.zeros(shape=self.image.shape, dtype=np.bool)
         for filter_descriptor in filter_list:
                 for filter_name, filter_kwargs in filter_descriptor.iteritems():
                     filter_func = Filters.filter_lookup(filter_name)
                     filtered_image = filter_func(image, **filter_kwargs)
                     mask = np.logical_or(mask, filtered_image)
+        return mask
 
-        blobbed = utils.filter_out_blobs(mask, min_blob_size)
+    def _skeleton(self, mask_key, filter_list, min_blob_size):
+        mask = self._memoize(mask_key, self._filter_mask, filter_list)
+        blobbed = utils.filter_out_blobs(mask.copy(), min_blob_size)
         skeletonized = skeletonize(blobbed)
-        skeletonized = skeletonized.astype('uint8')
+        return skeletonized.astype('uint8')
 
+    def _trace(self, mask_key, filter_list, min_blob_size, engine):
         # translate edges to contour paths
-        t0 = time.time(); print 'tracing...'
-        traj = utils.pixels_to_trajectory(skeletonized)
+        if engine == 'outline':
+            mask = self._memoize(mask_key, self._filter_mask, filter_list)
+            t0 = time.time(); print 'tracing...'
+            traj = utils.trace_outlines(mask, min_blob_size)
+        else:
+            skeletonized = self._memoize(
+                ('skeleton', mask_key, min_blob_size), self._skeleton,
+                mask_key, filter_list, min_blob_size)
+            t0 = time.time(); print 'tracing...'
+            traj = utils.pixels_to_trajectory(skeletonized)
         print '...%f' % (time.time() - t0)
+        return traj
 
-        # smooth
-        if smooth:
-            print 'smoothing...'
-            traj.smooth(**kwargs)
+    def _trace_tiled(self, filter_list, min_blob_size, engine, tile_size,
+                     halo, processes):
+        """
+        Runs the filter, blob and skeleton stages on overlapping tiles
+        in a process pool. Skeleton tiles are traced in the workers and
+        their strokes joined across tile borders, outline masks are
+        stitched together and traced as a whole.
+        """
+        h, w = self.image.shape
+        jobs, corners = [], []
+        for i0 in range(0, h, tile_size):
+            for j0 in range(0, w, tile_size):
+                i1, j1 = min(i0 + tile_size, h), min(j0 + tile_size, w)
+                a0, b0 = max(i0 - halo, 0), max(j0 - halo, 0)
+                a1, b1 = min(i1 + halo, h), min(j1 + halo, w)
+                core = (i0 - a0, i1 - a0, j0 - b0, j1 - b0)
+                jobs.append((self.image[a0:a1, b0:b1], core, filter_list,
+                             min_blob_size, engine))
+                corners.append((i0, i1, j0, j1))
+
+        t0 = time.time(); print 'tracing %d tiles...' % len(jobs)
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_contour_tile, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        if engine == 'outline':
+            mask = np.zeros(shape=self.image.shape, dtype=np.bool)
+            for (i0, i1, j0, j1), tile in zip(corners, results):
+                mask[i0:i1, j0:j1] = tile
+            traj = utils.trace_outlines(mask, min_blob_size)
+        else:
+            paths = []
+            for (i0, i1, j0, j1), tile in zip(corners, results):
+                # tile coordinates to image coordinates
+                shift = np.array((j0, h - i1))
+                paths += [path + shift for path in tile]
+            traj = Trajectory()
+            for path in utils.stitch_tile_paths(paths, tile_size, h):
+                traj.append(path)
+        print '...%f' % (time.time() - t0)
+        return traj
 
+    def _smooth(self, traj, kwargs):
+        print 'smoothing...'
+        traj = traj.copy()
+        traj.smooth(**kwargs)
         return traj
 
     def multiple_shifted_lines_plot(self, n_lines, n_scans, gain=1,
-                                    snake_scan=True):
+                                    snake_scan=True, alternate=False,
+                                    continuous=False, skip_below=None,
+                                    min_skip=20):
         """
         Returns a Trajectory consisting of multiple overlapping line scans,
         for the current image with darkness modulated by the vertical offset
         between scans.
+
+        alternate: Start every other scan from the bottom, and snake
+                   across scan boundaries, so that each scan starts
+                   where the previous one ended.
+
+        continuous: Join the lines of each snake scan into a single
+                    path, or all scans into one path if alternate.
+
+        skip_below: If given, stretches of the lines where the darkness
+                    (0 to 1) stays below this value are left out, so
+                    that they become fast pen-up travel instead.
+
+        min_skip: Blank stretches shorter than this many pixels are
+                  drawn anyway, to avoid pointless pen lifts.
         """
+        self._check_continuous(snake_scan, continuous)
+        offsets = np.linspace(-gain, gain, n_scans)
+        xy, blank = self._shifted_lines(n_lines, offsets, skip_below)
+
+        def arrange(a):
+            # the same line order and direction for points and segments
+            if alternate:
+                # every other scan bottom-up, then snake through everything
+                a[1::2] = a[1::2, ::-1].copy()
+                a = a.reshape((-1,) + a.shape[2:])
+                if snake_scan:
+                    a[1::2] = a[1::2, ::-1].copy()
+            else:
+                if snake_scan:
+                    a[:, 1::2] = a[:, 1::2, ::-1].copy()
+                a = a.reshape((-1,) + a.shape[2:])
+            return a
+        xy, blank = arrange(xy), arrange(blank)
 
-        master_trajectory = Trajectory()
-        for max_offset in np.linspace(-gain, gain, n_scans):
-            scan_trajectory = self._shifted_lines_plot(n_lines=n_lines, max_offset=max_offset,
-                                                       snake_scan=snake_scan)
-            master_trajectory.paths += scan_trajectory.paths # Maybe implement Trajectory.__add__?
-            # Todo: Add option to start every other iteration from the bottom
-        return master_trajectory
+        lines = Trajectory()
+        lines.append_packed(xy)
+        blank = list(blank)[:len(lines)]
+        if continuous:
+            self._make_continuous(lines, None if alternate else n_lines,
+                                  blank)
+        if skip_below is not None:
+            self._skip_blank(lines, blank, min_skip)
+        return lines
 
-    def _shifted_lines_plot(self, n_lines, max_offset=1, snake_scan=True):
+    def _shifted_lines_plot(self, n_lines, max_offset=1, snake_scan=True,
+                            continuous=False, skip_below=None, min_skip=20):
         """
         Returns line scan Trajectory for the current image with darkness
         modulated as vertical offset.
         """
+        self._check_continuous(snake_scan, continuous)
+        xy, blank = self._shifted_lines(n_lines, [max_offset], skip_below)
 
-        linewidth = self.image.shape[0] / n_lines
-        binnedImage = utils.bin_pixels(self.image, m=linewidth, n=1)
         lines = Trajectory()
-        for line in range(n_lines):
-            # j is the horizontal pixel index, one for each horizontal step
-            j = np.arange(binnedImage.shape[1])
-            # the darkness per stop of this particular line
-            lineIntensity = (255.0 - binnedImage[line]) / 255.0
-            # scale the waveform
-            i = max_offset * lineIntensity * linewidth / 2.0
-            # add the row offset
-            i += (linewidth * line + linewidth / 2)
-            # convert to cartesian coordinates
-            xy = np.vstack((j, n_lines * linewidth - i)).T
-            lines.append(xy)
+        lines.append_packed(xy[0])
+        blank = list(blank[0])[:len(lines)]
+        return self._finish_scan(lines, blank, snake_scan, continuous,
+                                 skip_below, min_skip)
 
-        if snake_scan:
-            self._make_snake_scan(lines)
+    def _shifted_lines(self, n_lines, offsets, skip_below=None):
+        """
+        Returns the lines of one shifted line scan for each max offset
+        in offsets, as an array of shape (scans, lines, points, 2),
+        together with the blank flags of their segments.
+        """
+        linewidth = self.image.shape[0] / n_lines
+        binnedImage = self._binned(linewidth, 1)
+        # j is the horizontal pixel index, one for each horizontal step
+        j = np.arange(binnedImage.shape[1], dtype=float)
+        # the darkness per stop of each line
+        intensity = (255.0 - binnedImage[:n_lines]) / 255.0
+        # scale the waveform, for all scans at once
+        i = np.asarray(offsets)[:, None, None] * intensity * linewidth / 2.0
+        # add the row offsets
+        i += (linewidth * np.arange(n_lines) + linewidth / 2)[:, None]
+        # convert to cartesian coordinates
+        x = np.broadcast_to(j, i.shape)
+        xy = np.stack((x, n_lines * linewidth - i), axis=-1)
+        # a segment is blank if both its ends are
+        blank = intensity < (skip_below or 0)
+        blank = blank[:, :-1] & blank[:, 1:]
+        blank = np.tile(blank, (len(offsets), 1, 1))
+        return xy, blank
+
+    def _check_continuous(self, snake_scan, continuous):
+        """
+        Continuous scans join the ends of neighbouring lines, so they
+        only work as snake scans. Checked before any scanning is done.
+        """
+        if continuous and not snake_scan:
+            raise ValueError('continuous scans require snake_scan')
 
+    def _finish_scan(self, lines, blank, snake_scan, continuous,
+                     skip_below, min_skip):
+        """
+        Applies the common snake, continuous and blank skipping options
+        to a raster scan, blank holding the blank flags of the segments
+        of each line.
+        """
+        if snake_scan:
+            self._make_snake_scan(lines, blank)
+        if continuous:
+            self._make_continuous(lines, blank=blank)
+        if skip_below is not None:
+            self._skip_blank(lines, blank, min_skip)
         return lines
 
-    def _make_snake_scan(self, traj):
+    def _make_snake_scan(self, traj, blank=None):
         """
-        Make a raster scan a snake scan in-place.
+        Make a raster scan a snake scan in-place, along with the
+        segment flags in blank if given.
         """
         for i in range(len(traj)):
             if i % 2:
                 # revert odd lines
                 traj[i] = np.flipud(traj[i])
+                if blank is not None:
+                    blank[i] = blank[i][::-1]
+
+    def _make_continuous(self, traj, lines_per_path=None, blank=None):
+        """
+        Join the lines of a snake scan in-place into continuous paths,
+        optionally with lines_per_path lines in each. The moves between
+        lines become short connectors at the margin. Segment flags in
+        blank are joined too, connectors being blank between blank
+        segments.
+        """
+        if not len(traj):
+            return
+        n = lines_per_path or len(traj)
+        traj.paths = [np.vstack(traj.paths[i:i + n])
+                      for i in range(0, len(traj), n)]
+        if blank is not None:
+            joined = []
+            for i in range(0, len(blank), n):
+                group = blank[i:i + n]
+                parts = [group[0]]
+                for before, after in zip(group[:-1], group[1:]):
+                    parts.append([before[-1] & after[0]])
+                    parts.append(after)
+                joined.append(np.hstack(parts).astype(bool))
+            blank[:] = joined
+
+    def _skip_blank(self, traj, blank, min_skip):
+        """
+        Split the paths of a raster scan in-place wherever they run
+        through blank stretches longer than min_skip horizontally, so
+        that those become pen-up travel. blank holds the blank flags
+        of the segments of each path.
+        """
+        if not len(traj):
+            return
+        points = np.vstack(traj.paths)
+        lengths = np.array([len(path) for path in traj])
+        # segments between all consecutive points, where those joining
+        # two paths are always cut
+        cross = np.zeros(len(points) - 1, dtype=bool)
+        cross[np.cumsum(lengths)[:-1] - 1] = True
+        flags = np.hstack([np.append(b, False) for b in blank])[:-1]
+
+        # horizontal extent of each blank stretch, short ones are drawn
+        dx = np.abs(np.diff(points[:, 0]))
+        run_start = flags & ~np.hstack((False, flags[:-1]))
+        run = np.cumsum(run_start) - 1
+        idx = np.nonzero(flags)[0]
+        extent = np.bincount(run[idx], weights=dx[idx])
+        flags[idx[extent[run[idx]] < min_skip]] = False
+
+        # new paths are the remaining runs of uncut segments
+        cut = np.hstack((True, flags | cross, True)).astype(int)
+        starts = np.nonzero(np.diff(cut) == -1)[0]
+        ends = np.nonzero(np.diff(cut) == 1)[0]
+        traj.paths = [points[a:b + 1] for a, b in zip(starts, ends)]
+
+
+def _imread_gray(filename, max_size=None):
+    """
+    Decodes an image file to 8 bit grayscale, at a reduced scale if
+    that still leaves at least max_size pixels along the longest side.
+    Reduced decoding only applies to JPEGs, whose size is read from the
+    file header, so that the image is decoded only once.
+    """
+    flag = cv2.IMREAD_GRAYSCALE
+    size = _jpeg_size(filename) if max_size is not None else None
+    if size is not None:
+        for f in (8, 4, 2):
+            name = 'IMREAD_REDUCED_GRAYSCALE_%d' % f
+            if hasattr(cv2, name) and max(size) // f >= max_size:
+                flag = getattr(cv2, name)
+                break
+    image = cv2.imread(filename, flag)
+    if image is None:
+        raise IOError('Could not read image %s' % filename)
+    return image
+
+
+def _jpeg_size(filename):
+    """
+    Returns the (height, width) of a JPEG file from its frame header,
+    or None if the file isn't a JPEG.
+    """
+    with open(filename, 'rb') as fp:
+        if fp.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            byte = fp.read(1)
+            if not byte:
+                return None
+            if byte != b'\xff':
+                continue
+            marker = fp.read(1)
+            while marker == b'\xff':
+                marker = fp.read(1)
+            if not marker:
+                return None
+            marker = ord(marker)
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                # markers without a segment
+                continue
+            header = fp.read(2)
+            if len(header) < 2:
+                return None
+            length = struct.unpack('>H', header)[0]
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                # start of frame: precision, height and width
+                data = fp.read(5)
+                if len(data) < 5:
+                    return None
+                return struct.unpack('>xHH', data)
+            if marker == 0xda:
+                # start of scan without a frame header
+                return None
+            fp.seek(length - 2, 1)
+
+
+def _reset_crossings(darkness, threshold, scale=255):
+    """
+    For each row of non-negative integer darkness values, finds the
+    columns where the running sum of darkness / scale exceeds
+    threshold, with the sum restarting from zero after each crossing.
+    The first column always goes into the sum but is never a crossing
+    itself. Works on all rows at once with a cumulative sum and
+    searchsorted, iterating only once per crossing.
+
+    The search is exact in integers. Where a sum hits the threshold
+    exactly, the float accumulation of a pixel-by-pixel loop is
+    replayed for that stretch, so the result is identical to such a
+    loop.
+
+    Returns a list with an array of crossing columns for each row.
+    """
+    n, width = darkness.shape
+    values = darkness.ravel()
+    cumsum = np.cumsum(darkness, axis=1).astype(np.float64)
+    target = scale * threshold
+    # offset the rows so they can be searched as one increasing array
+    offsets = np.arange(n) * (cumsum[:, -1].max() + target + 1)
+    flat = (cumsum + offsets[:, None]).ravel()
+    row_start = np.arange(n) * width
+
+    found = []
+    rows = np.arange(n)
+    level = offsets
+    start = row_start
+    minimum = row_start + 1
+    while len(rows):
+        pos = np.searchsorted(flat, level + target, side='right')
+        pos = np.maximum(pos, minimum)
+
+        # exact hits of the threshold
+        hit = np.searchsorted(flat, level + target, side='left')
+        ties = np.nonzero((hit < pos) & (hit >= minimum)
+                          & (flat[np.minimum(hit, len(flat) - 1)] == level + target))[0]
+        for k in ties:
+            acc = np.cumsum(values[start[k]:hit[k] + 1] / float(scale))[-1]
+            if acc > threshold:
+                pos[k] = hit[k]
+
+        ok = pos < row_start[rows] + width
+        rows, pos = rows[ok], pos[ok]
+        found.append((rows, pos - row_start[rows]))
+        level = flat[pos]
+        start = minimum = pos + 1
+
+    rows = np.hstack([r for r, p in found])
+    cols = np.hstack([p for r, p in found])
+    order = np.lexsort((cols, rows))
+    counts = np.bincount(rows, minlength=n)
+    return np.split(cols[order], np.cumsum(counts)[:-1])
+
+
+def _contour_tile(job):
+    """
+    Worker for Sketch._trace_tiled, which processes a single tile with
+    its halo and returns the mask (outline engine) or the traced paths
+    (skeleton engine) of the tile core.
+    """
+    image, (i0, i1, j0, j1), filter_list, min_blob_size, engine = job
+    sketch = Sketch(cache_size=0)
+    sketch.image = image
+    mask = sketch._filter_mask(filter_list)
+    if engine == 'outline':
+        return mask[i0:i1, j0:j1]
+    blobbed = utils.filter_out_blobs(mask, min_blob_size)
+    skeletonized = skeletonize(blobbed).astype('uint8')[i0:i1, j0:j1]
+    return utils.pixels_to_trajectory(skeletonized).paths
+
+
+def _freeze(obj):
+    """
+    Turns nested lists and dicts of parameters into something hashable,
+    for use in cache keys.
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    return obj
 
 
 # example usage
@@ -1,5 +1,5 @@
 import numpy as np
-from .TrajectoryOptimization import one_opt
+from .TrajectoryOptimization import one_opt, hilbert_sort
 from ..drawing import TEST_SVG
 from . import bezier_utils
 
@@ -49,6 +49,25 @@ class Trajectory(object):
         if new.shape[0] > 1:
             self.paths.append(new)
 
+    def copy(self):
+        """
+        Returns a copy of the Trajectory, with copies of all paths.
+        """
+        new = Trajectory()
+        new.paths = [path.copy() for path in self.paths]
+        return new
+
+    def append_packed(self, packed):
+        """
+        Appends each row of an n-by-m-by-2 array as a path of m points.
+        The paths are views into the packed array, so this is cheap for
+        many paths of equal length.
+        """
+        assert packed.ndim == 3
+        assert packed.shape[2] == 2
+        if packed.shape[1] > 1:
+            self.paths.extend(packed)
+
     def yflip(self):
         """
         Flips the trajectory within its y-range.
@@ -260,10 +279,16 @@ class Trajectory(object):
             if self.contour_length(path_index=i)[0] < min_length:
                 self.paths.pop(i)
 
-    def optimize(self, timeout=10):
+    def optimize(self, timeout=10, presort=False):
         """
         Optimize travel.
+
+        presort: Order the paths along a Hilbert curve before the local
+                 search. With timeout=0 only the presorting is done,
+                 which is the fast option for very large trajectories.
         """
+        if presort:
+            hilbert_sort(self)
         one_opt(self, timeout)
 
     def add_frame(self, margin=0.05, brackets=None):
@@ -408,7 +433,7 @@ class Trajectory(object):
                                                   polyorder=polyorder,
                                                   **kwargs)
                 self.paths[i] = np.stack((xnew, ynew), axis=-1)
-            except TypeError:
+            except (TypeError, ValueError):
                 pass
 
 
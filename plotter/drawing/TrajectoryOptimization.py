@@ -57,3 +57,89 @@ def _flip_between(trajectory, first_index, second_index):
     trajectory[first_index:second_index] = trajectory[first_index:second_index][::-1]
     for path in trajectory[first_index:second_index]:
         path[:] = path[::-1]
+
+
+def hilbert_sort(trajectory, key='centroid', order=16):
+    """
+    Orders the paths of a trajectory along a Hilbert curve through their
+    key points, then orients each path so that it starts close to where
+    the previous one ends. Fully vectorized and O(n log n), so it gives
+    a decent tour in well under a second even for 100k paths. Useful on
+    its own or as the seed for one_opt.
+
+    key:   'centroid' (mean of all points in a path) or 'endpoints'
+           (midpoint between the first and last point of a path).
+    order: Number of Hilbert curve levels, the key points are
+           quantized onto a 2**order by 2**order grid.
+    """
+    if len(trajectory) < 2:
+        return
+
+    points, starts, ends = _pack_endpoints(trajectory)
+    if key == 'centroid':
+        lengths = ends - starts + 1
+        keys = np.add.reduceat(points, starts, axis=0) / lengths[:, None]
+    elif key == 'endpoints':
+        keys = (points[starts] + points[ends]) / 2.0
+    else:
+        raise ValueError('key must be centroid or endpoints')
+
+    # quantize onto the Hilbert grid and sort by curve index
+    n = 2 ** order
+    lo = keys.min(axis=0)
+    span = keys.max(axis=0) - lo
+    span[span == 0] = 1.0
+    grid = ((keys - lo) / span.max() * (n - 1)).astype(np.int64)
+    inds = np.argsort(_hilbert_index(grid[:, 0], grid[:, 1], n), kind='mergesort')
+    keys = keys[inds]
+    first = points[starts[inds]]
+    last = points[ends[inds]]
+
+    # orientation pass: flip a path if that brings its start closer
+    # to the preceding key point and its end closer to the following one
+    before = np.vstack((keys[:1], keys[:-1]))
+    after = np.vstack((keys[1:], keys[-1:]))
+    as_is = (np.linalg.norm(first - before, axis=1)
+             + np.linalg.norm(last - after, axis=1))
+    flipped = (np.linalg.norm(last - before, axis=1)
+               + np.linalg.norm(first - after, axis=1))
+    flip = flipped < as_is
+
+    paths = trajectory.paths
+    trajectory.paths = [paths[i][::-1] if f else paths[i]
+                        for i, f in zip(inds, flip)]
+
+
+def _pack_endpoints(trajectory):
+    """
+    Concatenates all paths into one array and returns it together with
+    the indices of the first and last point of each path.
+    """
+    lengths = np.array([len(path) for path in trajectory])
+    ends = np.cumsum(lengths) - 1
+    starts = ends - lengths + 1
+    points = np.concatenate(trajectory.paths).astype(float)
+    return points, starts, ends
+
+
+def _hilbert_index(x, y, n):
+    """
+    Distance along a Hilbert curve filling an n-by-n grid, for integer
+    coordinate arrays x and y. n must be a power of two.
+    """
+    x = x.copy()
+    y = y.copy()
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s //= 2
+    return d
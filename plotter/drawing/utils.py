@@ -5,29 +5,61 @@ try:
     HAS_SKIM = True
 except ImportError:
     HAS_SKIM = False
+try:
+    import cv2
+    HAS_CV2 = True
+except ImportError:
+    HAS_CV2 = False
 
 from .Trajectory import Trajectory
 
 
 def bin_pixels(image, m=1, n=1):
     """
-    Explicitly downsamples an image by an integer amount, by binning
-    adjacent pixels m-by-n. Odd pixels on the bottom and right are
-    discarded.
+    Explicitly downsamples an image by binning adjacent pixels m-by-n.
+    Odd pixels on the bottom and right are discarded. Integer images
+    stay integer, with the bin means rounded.
+
+    Bin sizes don't have to be integers, in which case bin edges are
+    rounded to the nearest pixel and bins differ in size by one pixel.
     """
+    size0 = int(image.shape[0] // m)
+    size1 = int(image.shape[1] // n)
+    if m == int(m) and n == int(n):
+        # reshape so that every bin gets its own pair of axes
+        m, n = int(m), int(n)
+        blocks = image[:size0 * m, :size1 * n].reshape(
+            (size0, m, size1, n) + image.shape[2:])
+        new = np.mean(blocks, axis=(1, 3))
+    else:
+        rows = np.round(np.arange(size0 + 1) * m).astype(int)
+        cols = np.round(np.arange(size1 + 1) * n).astype(int)
+        cropped = image[:rows[-1], :cols[-1]].astype(np.float64)
+        sums = np.add.reduceat(cropped, rows[:-1], axis=0)
+        sums = np.add.reduceat(sums, cols[:-1], axis=1)
+        counts = np.outer(np.diff(rows), np.diff(cols))
+        new = sums / counts.reshape(counts.shape + (1,) * (image.ndim - 2))
+    if issubclass(image.dtype.type, np.integer):
+        new = np.round(new)
+    return new.astype(image.dtype)
 
-    size = np.array(image.shape)
-    size[0] = size[0] // m
-    size[1] = size[1] // n
-    new = np.zeros(size, dtype=image.dtype)
-    for i in range(size[0]):
-        for j in range(size[1]):
-            tmp = np.mean(image[i * m: (i + 1) * m, j * n: (j + 1) * n], axis=(0, 1))
-            if issubclass(image.dtype.type, np.integer):
-                new[i, j] = np.round(tmp)
-            else:
-                new[i, j] = tmp
-    return new
+
+def pyramid(image, levels, factor=2):
+    """
+    Returns a list of progressively downsampled versions of an image,
+    starting with the image itself and binning by factor-by-factor
+    between levels. Each level is binned from the unrounded previous
+    one, so that rounding errors don't accumulate.
+    """
+    out = [image]
+    current = image.astype(np.float64)
+    for level in range(1, levels):
+        current = bin_pixels(current, factor, factor)
+        if issubclass(image.dtype.type, np.integer):
+            out.append(np.round(current).astype(image.dtype))
+        else:
+            out.append(current.astype(image.dtype))
+    return out
 
 
 def filter_out_blobs(image, cutoff_area):
@@ -52,51 +84,236 @@ def square(image):
     return image
 
 
+# neighbour offsets of the skeleton graph, orthogonal ones first, and
+# the slot pointing back along each of them
+_OFFSETS = [(-1, 0), (1, 0), (0, -1), (0, 1),
+            (-1, -1), (-1, 1), (1, -1), (1, 1)]
+_OPPOSITE = [1, 0, 3, 2, 7, 6, 5, 4]
+
+
+def skeleton_graph(image):
+    """
+    Builds the pixel graph of a skeletonized image in one vectorized
+    pass. Pixels are connected to their orthogonal neighbours, and to
+    diagonal neighbours only when no orthogonal pixel already links the
+    two, which keeps staircases from looking like junctions.
+
+    Returns (pixels, neighbours, degree), where pixels is an N-by-2
+    array of (row, column) indices, neighbours an N-by-8 array of
+    neighbour pixel numbers (-1 where there is none) in the order of
+    _OFFSETS, and degree the number of neighbours of each pixel.
+    Endpoints have degree 1 and junctions degree 3 or more.
+    """
+    padded = np.pad(image > 0, 1, mode='constant')
+    ii, jj = np.nonzero(padded)
+    index = -np.ones(padded.shape, dtype=np.int64)
+    index[ii, jj] = np.arange(len(ii))
+
+    neighbours = np.empty((len(ii), 8), dtype=np.int64)
+    for slot, (di, dj) in enumerate(_OFFSETS):
+        neighbours[:, slot] = index[ii + di, jj + dj]
+        if di and dj:
+            redundant = padded[ii + di, jj] | padded[ii, jj + dj]
+            neighbours[redundant, slot] = -1
+    degree = np.sum(neighbours >= 0, axis=1)
+
+    pixels = np.vstack((ii - 1, jj - 1)).T
+    return pixels, neighbours, degree
+
+
+def _nearest_pixel(free, node, pos, nodes=True):
+    """
+    Finds the pixel closest to pos which still has untraced edges,
+    preferring endpoints and junctions unless nodes is False, meaning
+    none of them are left. Searches in square windows of doubling size,
+    so the cost depends on the distance to the hit rather than on the
+    image size. Returns None when nothing is left.
+    """
+    i, j = pos
+    for nodes_only in ((True, False) if nodes else (False,)):
+        r = 1
+        while True:
+            i0, j0 = max(i - r, 0), max(j - r, 0)
+            window = free[i0:i + r + 1, j0:j + r + 1] > 0
+            if nodes_only:
+                window &= node[i0:i + r + 1, j0:j + r + 1]
+            ii, jj = np.nonzero(window)
+            whole = (window.shape == free.shape)
+            if len(ii):
+                d = (ii + i0 - i)**2 + (jj + j0 - j)**2
+                k = np.argmin(d)
+                # anything outside the window is further away than r
+                if d[k] <= r**2 or whole:
+                    return ii[k] + i0, jj[k] + j0
+            if whole:
+                break
+            r *= 2
+    return None
+
+
 def pixels_to_trajectory(image):
+    """
+    Traces a skeletonized image into a Trajectory with one path per
+    stroke, where strokes are the edges of the skeleton's pixel graph
+    between endpoints and junctions. Closed loops become closed paths.
+    Each new path starts from the untraced endpoint or junction nearest
+    to where the previous one finished, so the paths come out ordered
+    for short travel.
+    """
+    pixels, neighbours, degree = skeleton_graph(image)
+    nbrs = neighbours.tolist()
+    is_node = (degree != 2).tolist()
+    slots = [[s for s in range(8) if n[s] >= 0] for n in nbrs]
+    visited = [[False] * 8 for n in nbrs]
 
-    def walk(image, start, max_steps):
+    # per-pixel maps of untraced edges and of graph nodes, for finding
+    # the next starting point
+    index = -np.ones(image.shape, dtype=np.int64)
+    index[pixels[:, 0], pixels[:, 1]] = np.arange(len(pixels))
+    free = np.zeros(image.shape, dtype=np.int64)
+    free[pixels[:, 0], pixels[:, 1]] = degree
+    node = np.zeros(image.shape, dtype=bool)
+    node[pixels[:, 0], pixels[:, 1]] = degree != 2
+    remaining = np.sum(degree) // 2
+    # untraced edge ends at nodes, once there are none only loops are
+    # left and searching for nodes is wasted
+    at_node = degree != 2
+    node_ends = np.sum(degree[at_node])
+
+    def walk(a):
         """
-        Generator which walks along positive pixels and yields the indices passed.
-        Returns when the end of the line is reached or after max_steps.
+        Follows untraced edges from pixel a until a node is reached or
+        a loop closes, marking the edges as traced.
         """
-        i, j = start
-        mask = np.empty((3,3), dtype=np.uint8)
-        for step in range(max_steps):
-            yield i, j
-            mask[:] = 1
-            mask[1, 1] = 0
-            if step:
-                mask[last_pos] = 0
-            masked = mask * image[i-1:i+2, j-1:j+2]
-            if not masked.max():
-                return
-            direction = np.array(np.unravel_index(np.argmax(masked), (3,3))) - 1
-            last_pos = tuple(1 - direction)
-            i += direction[0]
-            j += direction[1]
-
-    # cheat the boundaries
-    image[0,:] = 0
-    image[-1, :] = 0
-    image[:, -1] = 0
-    image[:, 0] = 0
+        t = [a]
+        while True:
+            for slot in slots[a]:
+                if not visited[a][slot]:
+                    break
+            else:
+                return t
+            b = nbrs[a][slot]
+            visited[a][slot] = True
+            visited[b][_OPPOSITE[slot]] = True
+            t.append(b)
+            if is_node[b]:
+                return t
+            a = b
 
     traj = Trajectory()
-    while image.max():
-        # pick an arbitrary positive pixel
-        i, j = np.unravel_index(np.argmax(image), image.shape)
-
-        # try finding the end of the line, max N pixels
-        for ind in walk(image, (i, j), 1000):
-            pass
+    pos = (0, 0)
+    while remaining:
+        pos = _nearest_pixel(free, node, pos, nodes=node_ends > 0)
+        t = walk(index[pos])
+        remaining -= len(t) - 1
+        node_ends -= np.sum(at_node[t[:-1]]) + np.sum(at_node[t[1:]])
 
-        # walk again
-        t = []
-        for ind in walk(image, ind, 1000):
-            t.append(ind)
-            image[ind] = 0
+        # each traced edge uses up one slot at either end
+        arr = pixels[t]
+        np.subtract.at(free, (arr[:-1, 0], arr[:-1, 1]), 1)
+        np.subtract.at(free, (arr[1:, 0], arr[1:, 1]), 1)
+        pos = tuple(arr[-1])
 
-        arr = np.fliplr(np.array(t))
+        arr = np.fliplr(arr)
         arr[:, 1] = image.shape[0] - arr[:, 1]
         traj.append(arr)
     return traj
+
+
+def stitch_tile_paths(paths, tile_size, height):
+    """
+    Joins paths traced separately on square tiles of a pixel image
+    wherever their endpoints are neighbouring pixels on either side of
+    a tile border. Paths are in the cartesian pixel coordinates of
+    pixels_to_trajectory, height being the height of the whole image.
+    Returns a list of the joined paths.
+    """
+    def tile(pixel):
+        return pixel[0] // tile_size, pixel[1] // tile_size
+
+    # (row, column) of each path end, and the path ends at each pixel
+    ends = {}
+    for n, path in enumerate(paths):
+        for end, point in ((0, path[0]), (1, path[-1])):
+            pixel = (int(height - point[1]), int(point[0]))
+            ends.setdefault(pixel, []).append((n, end))
+
+    # link every path end to at most one end across a border
+    link = {}
+    for pixel, items in ends.items():
+        for item in items:
+            for di, dj in _OFFSETS:
+                if item in link:
+                    break
+                other = (pixel[0] + di, pixel[1] + dj)
+                if tile(other) == tile(pixel):
+                    continue
+                for candidate in ends.get(other, []):
+                    if candidate not in link and candidate[0] != item[0]:
+                        link[item] = candidate
+                        link[candidate] = item
+                        break
+
+    visited = [False] * len(paths)
+
+    def chain(n, end):
+        """
+        Follows links from path n, entering it at end.
+        """
+        parts = []
+        while not visited[n]:
+            visited[n] = True
+            parts.append(paths[n] if end == 0 else paths[n][::-1])
+            if (n, 1 - end) not in link:
+                break
+            n, end = link[(n, 1 - end)]
+        return np.vstack(parts)
+
+    # open chains start from an unlinked end, what's left are loops
+    joined = []
+    for n in range(len(paths)):
+        if not visited[n] and (n, 0) not in link:
+            joined.append(chain(n, 0))
+        elif not visited[n] and (n, 1) not in link:
+            joined.append(chain(n, 1))
+    for n in range(len(paths)):
+        if not visited[n]:
+            joined.append(chain(n, 0))
+    return joined
+
+
+def trace_outlines(mask, min_blob_size=0):
+    """
+    Traces the outlines of the blobs in a binary mask into a Trajectory
+    of closed paths, as a cheaper alternative to skeletonizing and
+    tracing. Uses the OpenCV border follower where available and
+    otherwise sub-pixel marching squares from skimage.
+
+    min_blob_size: blobs with an area below this value are filtered out
+    """
+    mask = np.pad(mask > 0, 1, mode='constant')
+    traj = Trajectory()
+    if HAS_CV2:
+        mask = mask.astype(np.uint8)
+        if min_blob_size:
+            n, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            keep = stats[:, cv2.CC_STAT_AREA] >= min_blob_size
+            keep[0] = False
+            mask = keep[labels].astype(np.uint8)
+        # the number of return values differs between OpenCV versions
+        contours = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)[-2]
+        contours = [np.vstack((c[:, 0], c[:1, 0])).astype(float) for c in contours]
+    elif HAS_SKIM:
+        from skimage import measure
+        if min_blob_size:
+            mask = filter_out_blobs(mask, min_blob_size)
+        contours = [np.fliplr(c) for c in measure.find_contours(mask.astype(float), 0.5)]
+    else:
+        raise RuntimeError('This operation requires OpenCV or skimage.')
+
+    for xy in contours:
+        # undo the padding and convert to cartesian coordinates
+        xy -= 1
+        xy[:, 1] = mask.shape[0] - 2 - xy[:, 1]
+        traj.append(xy)
+    return traj
@@ -0,0 +1,182 @@
+"""
+Fake module corresponding to pigpio, for running and benchmarking the
+wave based stepping on non RPi machines. Instead of driving any pins,
+pi() objects record the pulses of every wave they transmit.
+
+Waves are "transmitted" in real time by default, so that the busy and
+current wave queries behave like on the hardware. With realtime=False,
+every wave is done as soon as it is sent.
+
+Wave resources are limited to wave_get_max_pulses() pulses and reused
+like by the daemon: the resources of a deleted wave are only freed
+once all higher numbered waves are deleted too, or taken over by a new
+padded wave of the same size.
+"""
+
+import time
+import numpy as np
+
+print "Using fake pigpio."
+
+INPUT, OUTPUT = 0, 1
+WAVE_MODE_ONE_SHOT = 0
+WAVE_MODE_REPEAT = 1
+WAVE_MODE_ONE_SHOT_SYNC = 2
+WAVE_MODE_REPEAT_SYNC = 3
+WAVE_NOT_FOUND = 9998
+NO_TX_WAVE = 9999
+MAX_PULSES = 12000
+
+
+class error(Exception):
+    pass
+
+
+class pulse(object):
+
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+
+class pi(object):
+
+    def __init__(self, host=None, port=None, realtime=True):
+        self.connected = True
+        self.realtime = realtime
+        self.modes = {}
+        self.levels = 0
+        self._new = []
+        self._waves = {}
+        # (pulses, padded, in use) of the wave resources, by wave id
+        self._slots = []
+        # (wave id, start time, end time) of the waves sent
+        self._schedule = []
+        # transmitted pulses, as (gpio_on, gpio_off, delay) rows
+        self.transmitted = []
+
+    def stop(self):
+        self.connected = False
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    def write(self, gpio, level):
+        if level:
+            self.levels |= 1 << gpio
+        else:
+            self.levels &= ~(1 << gpio)
+
+    def hardware_PWM(self, gpio, frequency, dutycycle):
+        pass
+
+    def wave_clear(self):
+        self._new = []
+        self._waves = {}
+        self._slots = []
+        self._schedule = []
+
+    def wave_add_new(self):
+        self._new = []
+
+    def wave_add_generic(self, pulses):
+        self._new.extend((p.gpio_on, p.gpio_off, p.delay) for p in pulses)
+        return len(self._new)
+
+    def wave_get_max_pulses(self):
+        return MAX_PULSES
+
+    def wave_create(self):
+        return self._create(len(self._new), False)
+
+    def wave_create_and_pad(self, percent):
+        size = MAX_PULSES * percent // 100
+        if len(self._new) > size:
+            raise error('too many pulses for %d%% of the resources'
+                        % percent)
+        return self._create(size, True)
+
+    def _create(self, size, padded):
+        # free the resources of deleted waves at the top
+        while self._slots and not self._slots[-1][2]:
+            self._slots.pop()
+        wid = None
+        if padded:
+            for i, (pulses, pad, used) in enumerate(self._slots):
+                if not used and pad and pulses == size:
+                    wid = i
+                    break
+        if wid is None:
+            if sum(slot[0] for slot in self._slots) + size > MAX_PULSES:
+                raise error('no more resources for waveform')
+            wid = len(self._slots)
+            self._slots.append(None)
+        self._slots[wid] = (size, padded, True)
+        self._waves[wid] = np.array(self._new, dtype=np.int64).reshape(-1, 3)
+        self._new = []
+        return wid
+
+    def wave_delete(self, wid):
+        if any(w == wid for w, start, end in self._current()):
+            raise RuntimeError('Deleting wave %d while in use' % wid)
+        del self._waves[wid]
+        size, padded, used = self._slots[wid]
+        self._slots[wid] = (size, padded, False)
+
+    def wave_send_once(self, wid):
+        return self.wave_send_using_mode(wid, WAVE_MODE_ONE_SHOT)
+
+    def wave_send_using_mode(self, wid, mode):
+        pulses = self._waves[wid]
+        now = self._now()
+        start = now
+        if mode == WAVE_MODE_ONE_SHOT_SYNC and self._schedule:
+            start = max(now, self._schedule[-1][2])
+        elif self._schedule:
+            # a plain send aborts whatever is being sent
+            self._schedule = [s for s in self._schedule if s[2] <= now]
+        duration = pulses[:, 2].sum() * 1e-6
+        self._schedule.append((wid, start, start + duration))
+        self.transmitted.append(pulses)
+        return len(pulses)
+
+    def wave_tx_busy(self):
+        return int(len(self._current()) > 0)
+
+    def wave_tx_at(self):
+        current = self._current()
+        if not current:
+            return NO_TX_WAVE
+        return current[0][0]
+
+    def wave_tx_stop(self):
+        self._schedule = []
+
+    def _now(self):
+        return time.time() if self.realtime else 0.0
+
+    def _current(self):
+        now = self._now()
+        if not self.realtime:
+            return []
+        return [s for s in self._schedule if s[2] > now]
+
+    def pulses(self):
+        """
+        Returns all transmitted pulses as one (gpio_on, gpio_off, delay)
+        array.
+        """
+        if not self.transmitted:
+            return np.zeros((0, 3), dtype=np.int64)
+        return np.vstack(self.transmitted)
+
+    def rising_edges(self, gpio):
+        """
+        Returns the times in microseconds at which gpio was switched on
+        by the transmitted pulses, counting from the first pulse.
+        """
+        pulses = self.pulses()
+        times = np.hstack(([0], np.cumsum(pulses[:, 2])[:-1]))
+        on = (pulses[:, 0] >> gpio) & 1 > 0
+        return times[on]
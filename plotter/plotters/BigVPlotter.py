@@ -1,12 +1,71 @@
 from ..motors import TMC2130
 from ..motors import PenLifter
+from .Waveform import Waveform
+from .WaveformCache import WaveformCache
 try:
     import RPi.GPIO as GPIO
 except ImportError:
-    from ..motors import DummyIO as GPIO
+    from ..gadgets import DummyIO as GPIO
 import time
+import ctypes
+import ctypes.util
+import traceback
+import multiprocessing
 import numpy as np
 
+
+def _monotonic_clock():
+    """
+    Returns a function giving the time in seconds from a clock which
+    doesn't jump when the system time is set, e.g. by NTP, so that step
+    deadlines stay valid. Python 2 has no time.monotonic, so the clock
+    is read with clock_gettime(CLOCK_MONOTONIC) through ctypes. Falls
+    back to time.time where neither is available.
+    """
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    for name in ('rt', 'c'):
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library(name))
+            clock_gettime = lib.clock_gettime
+        except (OSError, AttributeError, TypeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        t = timespec()
+        ref = ctypes.byref(t)
+        if clock_gettime(CLOCK_MONOTONIC, ref) != 0:
+            continue
+
+        def clock():
+            clock_gettime(CLOCK_MONOTONIC, ref)
+            return t.tv_sec + t.tv_nsec * 1e-9
+        return clock
+    return time.time
+
+clock = _monotonic_clock()
+
+
+def timing_stats(lateness):
+    """
+    Summarizes an array of step lateness values (in seconds) as a dict
+    with the number of steps and the mean, 99th percentile and maximum
+    lateness.
+    """
+    if len(lateness) == 0:
+        return {'steps': 0, 'mean': 0.0, 'p99': 0.0, 'max': 0.0}
+    return {'steps': len(lateness),
+            'mean': float(np.mean(lateness)),
+            'p99': float(np.percentile(lateness, 99)),
+            'max': float(np.max(lateness))}
+
+
 class BigVPlotter(object):
     """
     Class representing a large V-plotter built from two TMC2130 drivers.
@@ -14,6 +73,18 @@ class BigVPlotter(object):
     Origin at left motor point.
     """
 
+    # steps are timed by sleeping until this long before they are due,
+    # and busy-waiting for the rest
+    busy_wait = .002
+
+    # backend running the waveforms, see start_stepper_process() and
+    # start_wave_stepper()
+    stepper = None
+
+    # VelocityPlanner for acceleration limited waveforms, or None for
+    # constant velocity along each path
+    planner = None
+
     def __init__(self, separation=3497.0,
         xrng=(500.0, 3000.0), yrng=(-2100, -300)):
 
@@ -33,6 +104,9 @@ class BigVPlotter(object):
         # minimum delay between steps
         self.min_delay = .001
 
+        # prepared waveforms are kept on disk, set to None to disable
+        self.waveform_cache = WaveformCache()
+
         self.pen = PenLifter(up_pos=180, down_pos=90)
 
     @property
@@ -62,13 +136,42 @@ class BigVPlotter(object):
 
     @property
     def running(self):
+        if self.stepper is not None and not self.stepper.idle:
+            return True
         return self.m1.running or self.m2.running
 
     def move(self, x, y):
         m1, m2 = self._xy_to_pos(x, y)
+        if self.stepper is not None:
+            # the stepper owns the step pins, so it makes the move too
+            self.stepper.wait()
+            self.stepper.push(self._move_waveform(m1, m2))
+            return
         self.m1.absmove(m1, delay=self.min_delay)
         self.m2.absmove(m2, delay=self.min_delay)
 
+    def _move_waveform(self, m1, m2):
+        """
+        Returns the Waveform of a move to the motor positions m1 and m2,
+        both motors stepping at min_delay like the threaded moves of
+        the motors themselves.
+        """
+        times, isleft, direction = [], [], []
+        for left, motor, target in ((True, self.m1, m1),
+                                    (False, self.m2, m2)):
+            # hardware steps, and the matching waveform direction
+            steps = int(round((target - motor.position) / motor.per_step))
+            n = abs(steps)
+            times.append(np.arange(1, n + 1) * self.min_delay)
+            isleft.append(np.full(n, left, dtype=bool))
+            direction.append(np.full(n, np.sign(steps) *
+                                     np.sign(motor.per_step), dtype=int))
+        times = np.hstack(times)
+        order = np.argsort(times, kind='mergesort')
+        delays = np.diff(np.hstack(([0.0], times[order])))
+        return Waveform.from_arrays(delays, np.hstack(isleft)[order],
+                                    np.hstack(direction)[order])
+
     def _single_segment(self, x0, x1, y0, y1, T):
         """
         Takes a single straight segment of a Trajectory path (starting and
@@ -89,8 +192,12 @@ class BigVPlotter(object):
 
         # start and finish in motor coords
         ml0, mr0 = self._xy_to_pos(x0, y0)
+        if T == 0:
+            return (np.zeros(0), np.zeros(0, dtype=bool),
+                    np.zeros(0, dtype=int)) + self._pos_to_xy(ml0, mr0)
 
-        # calculate tl and tr
+        # the string lengths are ml(t) = sqrt(a*t**2 + bl*t + cl) and
+        # mr(t) = sqrt(a*t**2 + br*t + cr)
         # helpers
         Tx = (x1 - x0) / T
         Ty = (y1 - y0) / T
@@ -99,64 +206,11 @@ class BigVPlotter(object):
         cl = y0**2 + x0**2
         br = (-2 * (L - x0) * Tx + 2 * y0 * Ty)
         cr = (L - x0)**2 + y0**2
+        dl = x0 * Tx + y0 * Ty
+        dr = (x0 - L) * Tx + y0 * Ty
 
-        # tl:
-        tl = []
-        dirl = []
-        mlsteps_ = 0
-        ml_ = ml0
-        t_ = 0
-        while t_ < T:
-            dl = x0 * Tx + y0 * Ty
-            ml_grad = 1 / ml_ * (dl + a * t_)
-            if np.abs(ml_grad) < 1e-6:
-                # dml/dt = 0, consult second derivative
-                dirl.append(np.sign(a / ml_))
-            elif ml_grad > 0:
-                dirl.append(1)
-            elif ml_grad < 0:
-                dirl.append(-1)
-            mlsteps_ += dirl[-1]
-            ml_ = ml0 + mlsteps_ * step
-            tl.append((-bl + np.sign(dirl[-1]) * np.sqrt(max(0, bl**2 - 4 * a * (cl - ml_**2)))) / 2 / a)
-            t_ = tl[-1]
-            assert tl[-1] >= 0
-
-            if t_ > T:
-                # overshoot protection: for some reason, going too far
-                # gives outrageous values of t. Unclear why!
-                ml_ -= dirl[-1] * step
-                tl.pop()
-                dirl.pop()
-
-        # tr:
-        tr = []
-        dirr = []
-        mrsteps_ = 0
-        mr_ = mr0
-        t_ = 0
-        while t_ < T:
-            dr = (x0 - L) * Tx + y0 * Ty
-            mr_grad = 1 / mr_ * (dr + a * t_)
-            if np.abs(mr_grad) < 1e-6:
-                # dmr/dt = 0, consult second derivative
-                dirr.append(np.sign(a / mr_))
-            elif mr_grad > 0:
-                dirr.append(1)
-            elif mr_grad < 0:
-                dirr.append(-1)
-            mrsteps_ += dirr[-1] 
-            mr_ = mr0 + mrsteps_ * step
-            tr.append((-br + np.sign(dirr[-1]) * np.sqrt(max(0, br**2 - 4 * a * (cr - mr_**2)))) / 2 / a)
-            t_ = tr[-1]
-            assert tr[-1] >= 0
-
-            if t_ > T:
-                # overshoot protection: for some reason, going too far
-                # gives outrageous values of t. Unclear why!
-                mr_ -= dirr[-1] * step
-                tr.pop()
-                dirr.pop()
+        tl, dirl, ml_ = self._step_times(ml0, a, bl, cl, dl, T, step)
+        tr, dirr, mr_ = self._step_times(mr0, a, br, cr, dr, T, step)
 
         # sort and assemble (using np.argsort, also tried manual walking)
         nl = len(tl)
@@ -176,47 +230,282 @@ class BigVPlotter(object):
 
         return delays, isleft, dirlr, xfinal, yfinal
 
+    def _step_times(self, m0, a, b, c, d, T, step):
+        """
+        Solves for the steps of one motor during a segment of duration
+        T, where the string length is m(t) = sqrt(a*t**2 + b*t + c),
+        m0 at t=0, and dm/dt has the sign of d + a*t. Returns
+            times:  array of step times
+            dirs:   array of step directions
+            mfinal: the string length after the last step
+
+        The string shortens until the turning point t = -d/a and then
+        lengthens, so the steps are one descending run of levels
+        m0 - step, m0 - 2*step, ... followed by one ascending run. All
+        crossing times of each run are solved at once, on the early
+        root of the quadratic when descending and the late one when
+        ascending. A level below the minimum length is reached at the
+        turning point, after which the string steps back up.
+        """
+        # lowest string length during the segment, to bound the descent
+        tmin = min(max(-d / a, 0), T)
+        mmin = np.sqrt(max(0, a * tmin**2 + b * tmin + c))
+        mT = np.sqrt(a * T**2 + b * T + c)
+
+        # descending run, which ends with the first step after which
+        # the string is no longer shortening
+        if 1 / m0 * d < -1e-6:
+            down = -np.arange(1, int((m0 - mmin) / step) + 3)
+            level = m0 + down * step
+            t = (-b - np.sqrt(np.maximum(0, b**2 - 4 * a * (c - level**2))))
+            t = t / 2 / a
+            done = np.nonzero(1 / level * (d + a * t) >= -1e-6)[0]
+            if len(done):
+                down = down[:done[0] + 1]
+        else:
+            down = np.zeros(0, dtype=int)
+
+        # ascending run, to beyond the final string length
+        first = 1 - len(down)
+        up = np.arange(first, max(int(np.ceil((mT - m0) / step)) + 3,
+                                  first + 1))
+
+        steps = np.hstack((down, up))
+        dirs = np.hstack((-np.ones(len(down), dtype=int),
+                          np.ones(len(up), dtype=int)))
+        level = m0 + steps * step
+        roots = dirs * np.sqrt(np.maximum(0, b**2 - 4 * a * (c - level**2)))
+        times = (-b + roots) / 2 / a
+
+        # the segment ends with the first step at or after T, which is
+        # dropped if it overshoots
+        last = np.nonzero(times >= T)[0][0]
+        if times[last] > T:
+            return times[:last], dirs[:last], level[last] - dirs[last] * step
+        return times[:last + 1], dirs[:last + 1], level[last]
+
     def prepare_waveform(self, path, velocity):
         """
         Takes a single path (in physical units) from a trajectory 
-        together with a velocity, and returns a synced waveform
-        as three arrays:
-            delays: array of delays to apply before each motor step
-            isleft: array of booleans which are True for the left 
-                    motor and False for the right motor
-            dir:    array of direction scalars (1 for positive, -1 for
-                    negative moves, where positive means lengthening the
-                    string)
+        together with a velocity, and returns a synced Waveform of
+        the delays, motors and directions of all the steps (see
+        _single_segment).
+        """
+        # without a chunk size, the whole waveform comes in one chunk
+        return next(self.iter_waveform(path, velocity))
+
+    def iter_waveform(self, path, velocity, chunk_size=None):
         """
-        delays, isleft, direction = [], [], []
+        Generates the waveform of prepare_waveform() in chunks covering
+        chunk_size segments of the path each, so that long paths can
+        be started before they are fully prepared. The last chunk may
+        be empty.
+
+        With a planner, velocity is the cruise velocity and the step
+        times follow the planned speed profile of each segment.
+        """
+        if self.planner is not None:
+            plan = self.planner.plan(path, velocity)
+            # time left over from the previous segment after its last step
+            carry = 0.0
+        segments = []
         x, y = path[0, 0], path[0, 1]
         for i in range(1, path.shape[0]):
             length = np.sqrt(np.sum((path[i, :] - np.array((x, y)))**2))
-            T = length / float(velocity)
+            if self.planner is None:
+                T = length / float(velocity)
+            else:
+                # solve for the distances at which the steps happen
+                T = length
             delay_, isleft_, dir_, x, y = self._single_segment(
                 x, path[i, 0], y, path[i, 1], T)
-            delays += list(delay_)
-            isleft += list(isleft_)
-            direction += list(dir_)
+            if self.planner is not None:
+                # the segment started from the last stepped position,
+                # so scale its distances to the planned segment
+                s = np.cumsum(delay_) * plan['length'][i - 1] / max(length,
+                                                                    1e-12)
+                t = self.planner.times(plan, i - 1, s)
+                delay_ = np.diff(np.hstack(([-carry], t)))
+                carry = plan['T'][i - 1] - (t[-1] if len(t) else -carry)
+            segments.append((delay_, isleft_, dir_))
+            if chunk_size and i % chunk_size == 0:
+                yield self._pack(segments)
+                segments = []
+
+        yield self._pack(segments)
+
+    def _pack(self, segments):
+        """
+        Packs a list of (delays, isleft, dir) segments into a Waveform.
+        """
+        if not segments:
+            return Waveform()
+        return Waveform.from_arrays(*[np.hstack(s) for s in zip(*segments)])
+
+    def _cache_key(self, path, velocity):
+        options = () if self.planner is None else self.planner.options
+        return self.waveform_cache.key(
+            path, velocity, self.L, (self.m1.per_step, self.m2.per_step),
+            options=options)
 
-        return delays, isleft, direction
+    def _waveforms(self, traj, velocity, chunk_size):
+        """
+        Generates (path index, waveform chunk, is last chunk) for all
+        paths of a trajectory, using and filling the waveform cache.
+        """
+        for i, path in enumerate(traj):
+            key = waveform = None
+            if self.waveform_cache is not None:
+                key = self._cache_key(path, velocity)
+                waveform = self.waveform_cache.get(key)
+            if waveform is not None:
+                yield i, waveform, True
+                continue
+
+            parts = []
+            chunks = self.iter_waveform(path, velocity, chunk_size)
+            chunk = next(chunks)
+            for following in chunks:
+                parts.append(chunk)
+                yield i, chunk, False
+                chunk = following
+            parts.append(chunk)
+            # store before the last yield, as nothing may resume this
+            # generator after the last path
+            if key is not None:
+                self.waveform_cache.put(key, Waveform.concatenate(parts))
+            yield i, chunk, True
+
+    def _produce(self, traj, velocity, chunk_size, queue):
+        """
+        Background worker which puts the prepared waveform chunks on a
+        queue, or the traceback if preparation fails.
+        """
+        try:
+            for item in self._waveforms(traj, velocity, chunk_size):
+                queue.put(item)
+        except Exception:
+            queue.put(traceback.format_exc())
 
-    def run_waveform(self, delays, isleft, direction):
+    def _consume(self, queue):
+        """
+        Generates the waveform chunks put on a queue by _produce().
+        """
+        while True:
+            item = queue.get()
+            if isinstance(item, str):
+                raise RuntimeError('Waveform preparation failed:\n' + item)
+            yield item
+
+    def run_waveform(self, waveform, isleft=None, direction=None,
+                     start=None):
         """
         Runs a consecutive waveform, as prepared by prepare_waveform().
+        Also takes the delays, isleft and direction arrays separately.
+
+        The steps are timed against absolute deadlines from start (a
+        clock() time, default now), so that the loop overhead doesn't
+        add up. How late each step was is kept in self.lateness, see
+        timing_stats().
+
+        Returns the deadline of the last step, which can be passed as
+        start to continue with the next chunk of the same path.
         """
         motormap = {True: self.m1, False: self.m2}
         dirmap = {True: int(np.sign(self.m1.per_step)),
                   False: int(np.sign(self.m2.per_step))}
-        for i in range(len(delays)):
-            time.sleep(delays[i])
-            dir_ = direction[i] * dirmap[isleft[i]]
-            motormap[isleft[i]].step(dir_)
+        if isleft is None:
+            steps = waveform.steps()
+        else:
+            steps = zip(waveform, isleft, direction)
+        lateness = np.zeros(len(waveform))
+        busy_wait = self.busy_wait
+        deadline = clock() if start is None else start
+        for i, (delay, left, dir_) in enumerate(steps):
+            deadline += delay
+            remaining = deadline - clock()
+            if remaining > busy_wait:
+                time.sleep(remaining - busy_wait)
+            now = clock()
+            while now < deadline:
+                now = clock()
+            motormap[left].step(dir_ * dirmap[left])
+            lateness[i] = now - deadline
+        self.lateness = lateness
+        return deadline
+
+    def start_stepper_process(self, **kwargs):
+        """
+        Starts a StepperProcess which runs the waveforms of plot() from
+        then on, keyword arguments are passed on to it.
+        """
+        from .StepperProcess import StepperProcess
+        self.stop_stepper_process()
+        self.stepper = StepperProcess(self, **kwargs)
+        return self.stepper
+
+    def start_wave_stepper(self, **kwargs):
+        """
+        Starts a WaveStepper which has pigpio run the waveforms of
+        plot() by DMA from then on, keyword arguments are passed on to
+        it.
+        """
+        from .WaveStepper import WaveStepper
+        self.stop_stepper_process()
+        self.stepper = WaveStepper(self, **kwargs)
+        return self.stepper
+
+    def stop_stepper_process(self):
+        if self.stepper is not None:
+            self.stepper.close()
+            self.stepper = None
+
+    def _run_path(self, waveform, last, waveforms):
+        """
+        Runs the waveform chunks of a path, the first of which is given
+        and the rest come from waveforms, and returns its step timing
+        statistics.
+        """
+        if self.stepper is not None:
+            # leave the move to the start out of the path's timing
+            self.stepper.wait()
+            self.stepper.stats()
+            self.stepper.begin()
+            self.stepper.push(waveform)
+            while not last:
+                _, waveform, last = next(waveforms)
+                self.stepper.push(waveform)
+            self.stepper.finish()
+            self.stepper.wait()
+            return self.stepper.stats()
+
+        end = self.run_waveform(waveform)
+        lateness = [self.lateness]
+        while not last:
+            _, waveform, last = next(waveforms)
+            # continue the timing of the path, unless waiting for the
+            # chunk already made it late
+            end = self.run_waveform(waveform, start=max(end, clock()))
+            lateness.append(self.lateness)
+        return timing_stats(np.hstack(lateness))
 
     def plot(self, traj, autoscale=True, velocity=30, pen_up_delay=1.0,
-                   pen_down_delay=1.0):
+                   pen_down_delay=1.0, lookahead=4, chunk_size=200):
         """
         Plot an entire Trajectory object.
+
+        Waveforms are prepared by a background process while the
+        previous paths are drawn. The step timing statistics of each
+        path (see timing_stats()) are collected in self.timing.
+
+        The steps are emitted in this process, or by the StepperProcess
+        if one has been started with start_stepper_process(), which then
+        also makes the moves between paths.
+
+        lookahead:  Number of waveform chunks to prepare ahead. With 0,
+                    each path is prepared just before it is drawn.
+        chunk_size: Number of path segments per waveform chunk, so that
+                    long paths start before they are fully prepared.
         """
 
         self.pen.up()
@@ -224,30 +513,58 @@ class BigVPlotter(object):
         if autoscale:
             traj.fit(self.xrange, self.yrange, keep_aspect=True)
 
-        # plot the trajectory
-        for i, path in enumerate(traj):
-
-            # move to starting position in the background
-            self.move(path[0, 0], path[0, 1])
-
-            # prepare a waveform
-            print 'preparing waveform %d/%d...' % (i, len(traj))
-            t0 = time.time()
-            delays, isleft, direction = self.prepare_waveform(path, velocity)
-            print '...done in %.1f seconds' % (time.time() - t0)
-
-            # run the waveform when ready
-            while self.running:
-                time.sleep(.01)
-            self.pen.down()
-            time.sleep(pen_down_delay)
-            self.run_waveform(delays, isleft, direction)
-            self.pen.up()
-            time.sleep(pen_up_delay)
+        self.timing = []
+        worker = None
+        done = False
+        if lookahead:
+            queue = multiprocessing.Queue(maxsize=lookahead)
+            worker = multiprocessing.Process(
+                target=self._produce,
+                args=(traj, velocity, chunk_size, queue))
+            worker.daemon = True
+            worker.start()
+            waveforms = self._consume(queue)
+        else:
+            waveforms = self._waveforms(traj, velocity, chunk_size)
+
+        try:
+            # plot the trajectory
+            for i, path in enumerate(traj):
+
+                # move to starting position in the background
+                self.move(path[0, 0], path[0, 1])
+
+                # get the first part of the waveform
+                print 'preparing waveform %d/%d...' % (i, len(traj))
+                t0 = time.time()
+                _, waveform, last = next(waveforms)
+                print '...done in %.1f seconds' % (time.time() - t0)
+
+                # run the waveform when ready
+                while self.running:
+                    time.sleep(.01)
+                self.pen.down()
+                time.sleep(pen_down_delay)
+                self.timing.append(
+                    self._run_path(waveform, last, waveforms))
+                self.pen.up()
+                if 'mean' in self.timing[-1]:
+                    print ('...lateness mean %(mean).2e s, p99 %(p99).2e s, '
+                           'max %(max).2e s' % self.timing[-1])
+                time.sleep(pen_up_delay)
+            done = True
+        finally:
+            if worker is not None:
+                # let the worker finish filling the cache, unless the
+                # plot was interrupted
+                if not done:
+                    worker.terminate()
+                worker.join()
 
     def stop(self):
         self.m1.stop()
         self.m2.stop()
+        self.stop_stepper_process()
 
     def __del__(self):
         """
@@ -289,6 +606,9 @@ class SmallVPlotter(BigVPlotter):
         # minimum delay between steps
         self.min_delay = .001
 
+        # prepared waveforms are kept on disk, set to None to disable
+        self.waveform_cache = WaveformCache()
+
         self.pen = PenLifter(up_pos=180, down_pos=90)
 
     def plot(self, traj, autoscale=True, velocity=20):
@@ -3,7 +3,7 @@ from ..gadgets.LimitSwitch import LimitSwitch
 try:
     import RPi.GPIO as GPIO
 except ImportError:
-    from ..motors import DummyIO as GPIO
+    from ..gadgets import DummyIO as GPIO
 import time
 import numpy as np
 
@@ -0,0 +1,262 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import multiprocessing
+import numpy as np
+
+from .Waveform import Waveform
+from .BigVPlotter import clock
+
+
+def _set_fifo(priority):
+    """
+    Switches the calling process to the SCHED_FIFO real-time policy
+    with the given priority. Python 2 has no os.sched_setscheduler, so
+    it is called from libc through ctypes there. Returns whether it
+    worked, which needs root or CAP_SYS_NICE.
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return True
+    except AttributeError:
+        pass
+    except OSError:
+        return False
+    SCHED_FIFO = 1
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        sched_setscheduler = libc.sched_setscheduler
+    except (OSError, AttributeError, TypeError):
+        return False
+    # struct sched_param only holds the priority
+    param = ctypes.c_int(int(priority))
+    return sched_setscheduler(0, SCHED_FIFO, ctypes.byref(param)) == 0
+
+
+class StepperProcess(object):
+    """
+    Separate process which emits the motor steps of a plotter, so that
+    the step timing doesn't share the GIL with waveform preparation,
+    image processing or anything else in the main process.
+
+    The main process pushes Waveforms into a ring buffer of packed step
+    runs in shared memory, which the stepping process consumes against
+    absolute deadlines. The plotter's positioning moves go through the
+    ring buffer as well, see BigVPlotter.move(), while the pen servo
+    keeps running from the main process. Two counters show how well this works:
+        underruns:    times the buffer ran empty in the middle of a
+                      path, so that the steps had to wait for data
+        backpressure: times push() found the buffer full and had to
+                      wait for the stepping process
+    """
+
+    def __init__(self, plotter, capacity=2**16, tick=1e-6, priority=None):
+        """
+        plotter:  The plotter whose motors to step.
+        capacity: Number of step runs the ring buffer holds.
+        tick:     Delay tick of the Waveforms to run.
+        priority: If given, try to run the stepping process with this
+                  SCHED_FIFO priority, or at least at a raised nice
+                  level. Ignored where not permitted.
+        """
+        self.plotter = plotter
+        self.capacity = int(capacity)
+        self.tick = float(tick)
+        self.priority = priority
+
+        itemsize = Waveform.dtype.itemsize
+        self._ring = multiprocessing.RawArray(ctypes.c_char,
+                                              self.capacity * itemsize)
+        self._head = multiprocessing.RawValue('L', 0)
+        self._tail = multiprocessing.RawValue('L', 0)
+        self._busy = multiprocessing.RawValue('b', 0)
+        self._active = multiprocessing.RawValue('b', 0)
+        self._stopped = multiprocessing.RawValue('b', 0)
+        self._underruns = multiprocessing.RawValue('L', 0)
+        self._backpressure = multiprocessing.RawValue('L', 0)
+        # net steps of each motor, for keeping the positions in sync
+        self._steps = multiprocessing.RawArray('l', 2)
+        self._synced = [0, 0]
+        # lateness count, sum and maximum, and a histogram in .1 ms bins
+        self._lateness = multiprocessing.RawArray('d', 3)
+        self._histogram = multiprocessing.RawArray('L', 1000)
+        self.histogram_bin = 1e-4
+
+        self._process = multiprocessing.Process(target=self._run)
+        self._process.daemon = True
+        self._process.start()
+
+    @property
+    def underruns(self):
+        return self._underruns.value
+
+    @property
+    def backpressure(self):
+        return self._backpressure.value
+
+    @property
+    def idle(self):
+        return self._head.value == self._tail.value and not self._busy.value
+
+    def begin(self):
+        """
+        Marks the start of a path, from which an empty buffer counts as
+        an underrun.
+        """
+        self._active.value = 1
+
+    def push(self, waveform):
+        """
+        Copies a Waveform into the ring buffer, waiting for space as
+        needed.
+        """
+        if waveform.tick != self.tick:
+            raise ValueError('Waveform tick %g differs from %g'
+                             % (waveform.tick, self.tick))
+        ring = np.frombuffer(self._ring, dtype=Waveform.dtype)
+        runs = waveform.runs
+        while len(runs):
+            head = self._head.value
+            free = self.capacity - (head - self._tail.value)
+            if free == 0:
+                # wait until a quarter of the buffer is free, rather than
+                # waking up for every run
+                self._backpressure.value += 1
+                target = min(self.capacity // 4, len(runs))
+                while self.capacity - (self._head.value -
+                                       self._tail.value) < target:
+                    time.sleep(.001)
+                continue
+            n = min(free, len(runs))
+            i = head % self.capacity
+            first = min(n, self.capacity - i)
+            ring[i:i + first] = runs[:first]
+            ring[:n - first] = runs[first:n]
+            # publish only after the runs are in place
+            self._head.value = head + n
+            runs = runs[n:]
+
+    def finish(self):
+        """
+        Marks the end of a path, after the last push().
+        """
+        self._active.value = 0
+
+    def wait(self):
+        """
+        Blocks until all pushed steps are done, and updates the motor
+        positions of the plotter.
+        """
+        while not self.idle:
+            time.sleep(.001)
+        self._sync()
+
+    def _sync(self):
+        for i, motor in enumerate((self.plotter.m1, self.plotter.m2)):
+            steps = self._steps[i]
+            motor.abs_steps += steps - self._synced[i]
+            self._synced[i] = steps
+
+    def stats(self, reset=True):
+        """
+        Returns the step timing statistics since the last reset, like
+        timing_stats() plus the underrun and backpressure counters. The
+        99th percentile comes from a histogram and is rounded up to
+        histogram_bin.
+        """
+        count, total, worst = self._lateness[:]
+        histogram = np.array(self._histogram[:])
+        result = {'steps': int(count),
+                  'mean': total / count if count else 0.0,
+                  'p99': 0.0,
+                  'max': worst,
+                  'underruns': self.underruns,
+                  'backpressure': self.backpressure}
+        if count:
+            index = np.searchsorted(np.cumsum(histogram), .99 * count)
+            result['p99'] = min((index + 1) * self.histogram_bin, worst)
+        if reset:
+            self._lateness[:] = [0, 0, 0]
+            self._histogram[:] = [0] * len(histogram)
+            self._underruns.value = 0
+            self._backpressure.value = 0
+        return result
+
+    def close(self):
+        """
+        Stops the stepping process, and updates the motor positions
+        with the steps that were made.
+        """
+        self._stopped.value = 1
+        self._process.join()
+        self._sync()
+
+    def _raise_priority(self):
+        if _set_fifo(self.priority):
+            return
+        try:
+            os.nice(-10)
+        except OSError:
+            pass
+
+    def _run(self):
+        """
+        The stepping loop, running in the separate process.
+        """
+        if self.priority is not None:
+            self._raise_priority()
+        ring = np.frombuffer(self._ring, dtype=Waveform.dtype)
+        motors = [self.plotter.m1, self.plotter.m2]
+        signs = [int(np.sign(m.per_step)) for m in motors]
+        busy_wait = self.plotter.busy_wait
+        lateness = self._lateness
+        histogram = self._histogram
+        bins = len(histogram)
+        deadline = None
+        starved = False
+        while not self._stopped.value:
+            tail = self._tail.value
+            if tail == self._head.value:
+                if self._active.value and deadline is not None:
+                    # out of data in the middle of a path
+                    if not starved:
+                        self._underruns.value += 1
+                        starved = True
+                else:
+                    deadline = None
+                time.sleep(.0002)
+                continue
+            if starved:
+                # restart the timeline rather than catching up
+                deadline = None
+                starved = False
+            delay, bits, count = ring[tail % self.capacity].tolist()
+            self._busy.value = 1
+            self._tail.value = tail + 1
+
+            delay = delay * self.tick
+            i = 0 if bits & Waveform.LEFT else 1
+            direction = 1 if bits & Waveform.POSITIVE else -1
+            if deadline is None:
+                deadline = clock()
+            for k in xrange(count):
+                # runs can last over a minute, so stop in between
+                if self._stopped.value:
+                    break
+                deadline += delay
+                remaining = deadline - clock()
+                if remaining > busy_wait:
+                    time.sleep(remaining - busy_wait)
+                now = clock()
+                while now < deadline:
+                    now = clock()
+                motors[i].step(direction * signs[i])
+                self._steps[i] += direction * signs[i]
+                late = now - deadline
+                lateness[0] += 1
+                lateness[1] += late
+                if late > lateness[2]:
+                    lateness[2] = late
+                histogram[min(int(late / self.histogram_bin), bins - 1)] += 1
+            self._busy.value = 0
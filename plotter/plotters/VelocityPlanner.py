@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class VelocityPlanner(object):
+    """
+    Look-ahead velocity planning for the paths of a plotter. Instead of
+    running every segment at constant velocity with instant starts and
+    stops, the speed is ramped with a limited acceleration. At the
+    junctions between segments the speed is limited by how sharp the
+    corner is, using the junction deviation model: the speed at which
+    a circular arc deviating at most deviation from the corner could be
+    taken with centripetal acceleration at the limit.
+
+    The junction speeds are found with a backward and a forward pass
+    over the whole path, after which each segment gets a trapezoidal
+    (accelerate, cruise, decelerate) or S-curve speed profile.
+    """
+
+    def __init__(self, acceleration, deviation=.05, scurve=False):
+        """
+        acceleration: Acceleration limit in physical units per s**2.
+        deviation:    Corner deviation tolerance in physical units.
+        scurve:       Ramp the speed along half cosines instead of
+                      linearly, so that the acceleration starts and
+                      ends smoothly. The peak acceleration is still
+                      the limit, so the ramps take pi/2 times longer.
+        """
+        self.acceleration = float(acceleration)
+        self.deviation = float(deviation)
+        self.scurve = scurve
+
+    @property
+    def options(self):
+        """
+        The parameters the timing depends on, for cache keys.
+        """
+        return (self.acceleration, self.deviation, float(self.scurve))
+
+    @property
+    def _a(self):
+        # S-curves reach the same speeds over the same distances as
+        # linear ramps with 2/pi of the peak acceleration
+        if self.scurve:
+            return self.acceleration * 2 / np.pi
+        return self.acceleration
+
+    def junction_speeds(self, path, velocity):
+        """
+        Returns the squared speed limit at each point of a path, zero
+        at the ends.
+        """
+        d = np.diff(np.asarray(path, dtype=np.float64), axis=0)
+        lengths = np.sqrt(np.sum(d**2, axis=1))
+        unit = d / np.maximum(lengths, 1e-12)[:, None]
+        cos = np.sum(unit[:-1] * unit[1:], axis=1)
+        # sine of half the angle between the incoming and outgoing
+        # directions reversed, 1 for straight junctions
+        sin = np.sqrt(np.clip(.5 * (1 + cos), 0, 1))
+        with np.errstate(divide='ignore'):
+            limit = np.where(sin < 1, self._a * self.deviation * sin /
+                             (1 - sin), np.inf)
+        limit = np.minimum(limit, float(velocity)**2)
+        return np.hstack(([0.0], limit, [0.0]))
+
+    def plan(self, path, velocity):
+        """
+        Plans the speeds along a path, and returns a dict of arrays with
+        one value per segment:
+            length:  segment length
+            v0, v1:  entry and exit speeds
+            vc:      cruise (or peak) speed
+            da, dd:  acceleration and deceleration distances
+            ta, td:  acceleration and deceleration times
+            T:       total time
+        """
+        a = self._a
+        path = np.asarray(path, dtype=np.float64)
+        lengths = np.sqrt(np.sum(np.diff(path, axis=0)**2, axis=1))
+        limit = self.junction_speeds(path, velocity)
+
+        # backward pass, so that every point can still slow down to the
+        # following limits: w[i] = min(limit[i], w[i+1] + 2*a*length[i])
+        reach = 2 * a * np.hstack(([0.0], np.cumsum(lengths)))
+        w = np.minimum.accumulate((limit + reach)[::-1])[::-1] - reach
+        # forward pass, so that every point can be reached from the
+        # previous one: v2[i] = min(w[i], v2[i-1] + 2*a*length[i-1])
+        v2 = np.minimum.accumulate(w - reach) + reach
+        v2 = np.clip(v2, 0, limit)
+
+        v0sq, v1sq = v2[:-1], v2[1:]
+        vcsq = np.minimum(float(velocity)**2,
+                          (2 * a * lengths + v0sq + v1sq) / 2)
+        vcsq = np.maximum(vcsq, np.maximum(v0sq, v1sq))
+        v0, v1, vc = np.sqrt(v0sq), np.sqrt(v1sq), np.sqrt(vcsq)
+        da = np.minimum((vcsq - v0sq) / (2 * a), lengths)
+        dd = np.minimum((vcsq - v1sq) / (2 * a), lengths - da)
+        ta = (vc - v0) / a
+        td = (vc - v1) / a
+        tc = (lengths - da - dd) / np.maximum(vc, 1e-12)
+        return {'length': lengths, 'v0': v0, 'v1': v1, 'vc': vc,
+                'da': da, 'dd': dd, 'ta': ta, 'td': td, 'T': ta + tc + td}
+
+    def times(self, plan, i, s):
+        """
+        Returns the times after the start of segment i of a plan at
+        which the distances s along the segment are reached.
+        """
+        s = np.asarray(s, dtype=np.float64)
+        length, v0, v1, vc, da, dd, ta, td, T = [
+            plan[k][i] for k in ('length', 'v0', 'v1', 'vc', 'da', 'dd',
+                                 'ta', 'td', 'T')]
+        # cruising
+        t = ta + (s - da) / max(vc, 1e-12)
+        # ramping up from the start, and down to the end
+        ramp_up = s < da
+        t[ramp_up] = self._ramp_time(s[ramp_up], v0, vc, ta)
+        ramp_down = s > length - dd
+        t[ramp_down] = T - self._ramp_time(length - s[ramp_down], v1, vc, td)
+        return np.clip(t, 0, T)
+
+    def _ramp_time(self, s, v0, vc, ta):
+        """
+        Returns the times at which distances s are covered while
+        ramping from speed v0 to vc in time ta.
+        """
+        a = self._a
+        t = (np.sqrt(v0**2 + 2 * a * s) - v0) / a
+        if not self.scurve or ta == 0:
+            return t
+
+        # the S-curve distance is monotonic in time, so bisect
+        def distance(t):
+            return v0 * t + (vc - v0) / 2 * (t - ta / np.pi *
+                                             np.sin(np.pi * t / ta))
+        low = np.zeros_like(s)
+        high = np.full_like(s, ta)
+        for k in range(50):
+            mid = (low + high) / 2
+            below = distance(mid) < s
+            low = np.where(below, mid, low)
+            high = np.where(below, high, mid)
+        return (low + high) / 2
@@ -0,0 +1,234 @@
+try:
+    import pigpio
+except ImportError:
+    from ..gadgets import FakePigpio as pigpio
+import time
+from collections import deque
+import numpy as np
+
+from .BigVPlotter import clock
+
+
+class WaveStepper(object):
+    """
+    Step backend which has the pigpio daemon time the steps by DMA,
+    instead of software timing. Waveforms are turned into pigpio pulse
+    lists, cut into waves of at most max_pulses pulses, and streamed by
+    queueing each wave to start when the previous one is done. Only a
+    few waves are kept in the daemon at a time, each padded to an equal
+    share of its resources, so that a new wave can take over the
+    resources of a deleted one.
+
+    Has the same begin, push, finish, wait, stats and close methods as
+    StepperProcess, so it can be used as BigVPlotter.stepper, see
+    BigVPlotter.start_wave_stepper(). Without pigpio installed, the fake
+    module from plotter.gadgets records the pulses instead.
+    """
+
+    def __init__(self, plotter, pi=None, pulse_width=2, max_pulses=4000,
+                 queued_waves=3):
+        """
+        plotter:      The plotter whose TMC2130 motors to step.
+        pi:           pigpio.pi() connection. Default: a new one.
+        pulse_width:  Length of the step pulses in microseconds. The
+                      direction pins are set this long before a step.
+        max_pulses:   Number of pulses per wave, at most the share of
+                      the daemon's pulses each wave is padded to.
+        queued_waves: Number of waves sent to the daemon ahead.
+        """
+        self.plotter = plotter
+        self.pi = pigpio.pi() if pi is None else pi
+        self.pulse_width = int(pulse_width)
+        self.queued_waves = queued_waves
+        self._pad = 100 // queued_waves
+        self.max_pulses = min(int(max_pulses),
+                              self.pi.wave_get_max_pulses() * self._pad // 100)
+
+        motors = [plotter.m1, plotter.m2]
+        self._signs = np.array([int(np.sign(m.per_step)) for m in motors])
+        self._step_masks = np.array([1 << m.step_pin for m in motors])
+        self._dir_masks = np.array([1 << m.dir_pin for m in motors])
+        for m in motors:
+            self.pi.set_mode(m.step_pin, pigpio.OUTPUT)
+            self.pi.set_mode(m.dir_pin, pigpio.OUTPUT)
+            self.pi.write(m.step_pin, 0)
+
+        self.pi.wave_clear()
+        # (wave id, expected start, step times, cumulative steps) of
+        # the waves in the daemon
+        self._waves = deque()
+        self._end = 0.0
+        self._pending = np.zeros(2, dtype=int)
+        self._active = False
+        self._sent = False
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.steps = 0
+        self.underruns = 0
+        self.backpressure = 0
+
+    def pulses(self, waveform):
+        """
+        Returns the (gpio_on, gpio_off, delay) rows of the pigpio pulses
+        for a Waveform, with delays in microseconds. Every step raises
+        its step pin for pulse_width, and direction pins are set
+        pulse_width before the steps where they change.
+        """
+        return self._pulses(*self._steps(waveform))
+
+    def _steps(self, waveform):
+        """
+        Returns the rising edge times in microseconds, the motor and
+        the direction pin level of every step of a Waveform.
+        """
+        delays, isleft, direction = waveform.to_arrays()
+        times = np.round(np.cumsum(delays) * 1e6).astype(np.int64)
+        times += self.pulse_width
+        motor = np.where(isleft, 0, 1)
+        # TMC2130 direction pin is high for negative hardware steps
+        high = direction * self._signs[motor] < 0
+        return times, motor, high
+
+    def _pulses(self, times, motor, high):
+        if len(times) == 0:
+            return np.zeros((0, 3), dtype=np.int64)
+        w = self.pulse_width
+
+        # the direction pins only need setting where they change, and
+        # at the first step of each motor
+        turn = np.zeros(len(times), dtype=bool)
+        for m in (0, 1):
+            steps = np.nonzero(motor == m)[0]
+            turn[steps] = np.hstack(([True], np.diff(high[steps]) != 0))
+
+        # events as (time, on mask, off mask)
+        zero = np.zeros(len(times), dtype=np.int64)
+        dir_mask = self._dir_masks[motor[turn]]
+        step_mask = self._step_masks[motor]
+        t = np.hstack((times[turn] - w, times, times + w))
+        on = np.hstack((np.where(high[turn], dir_mask, 0), step_mask, zero))
+        off = np.hstack((np.where(high[turn], 0, dir_mask), zero, step_mask))
+
+        # merge the events at equal times
+        order = np.argsort(t, kind='mergesort')
+        t, on, off = t[order], on[order], off[order]
+        starts = np.nonzero(np.hstack(([True], np.diff(t) > 0)))[0]
+        t = t[starts]
+        on = np.bitwise_or.reduceat(on, starts)
+        off = np.bitwise_or.reduceat(off, starts)
+        delay = np.diff(np.hstack((t, t[-1])))
+        # lead in to the first event
+        return np.vstack(([0, 0, t[0]], np.vstack((on, off, delay)).T))
+
+    def begin(self):
+        self._active = True
+        self._sent = False
+
+    def push(self, waveform):
+        """
+        Sends a Waveform to the daemon, waiting for queued waves to
+        finish as needed.
+        """
+        if len(waveform) == 0:
+            return
+        times, motor, high = self._steps(waveform)
+        pulses = self._pulses(times, motor, high)
+
+        # hardware steps of each motor, for updating the motor positions
+        steps = np.zeros((len(times), 2), dtype=int)
+        steps[np.arange(len(times)), motor] = np.where(high, -1, 1)
+        # start time of each pulse, for telling which steps a wave holds
+        starts = np.hstack(([0], np.cumsum(pulses[:, 2])))
+        for i in range(0, len(pulses), self.max_pulses):
+            j = min(i + self.max_pulses, len(pulses))
+            a, b = np.searchsorted(times, [starts[i], starts[j]])
+            self._send(pulses[i:j], times[a:b] - starts[i],
+                       np.cumsum(steps[a:b], axis=0))
+        self._pending += np.sum(steps, axis=0)
+        self.steps += len(waveform)
+
+    def _send(self, pulses, times, steps):
+        if self._active and self._sent and not self.pi.wave_tx_busy():
+            # everything sent so far is done, so this wave starts late
+            self.underruns += 1
+        self._retire()
+        if len(self._waves) >= self.queued_waves:
+            self.backpressure += 1
+            while len(self._waves) >= self.queued_waves:
+                time.sleep(.001)
+                self._retire()
+        self.pi.wave_add_generic([pigpio.pulse(*p) for p in pulses.tolist()])
+        wid = self.pi.wave_create_and_pad(self._pad)
+        self.pi.wave_send_using_mode(wid, pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+        start = max(clock(), self._end)
+        self._end = start + np.sum(pulses[:, 2]) * 1e-6
+        self._waves.append((wid, start, times, steps))
+        self._sent = True
+
+    def _retire(self):
+        """
+        Deletes the waves which are done.
+        """
+        if not self.pi.wave_tx_busy():
+            current = None
+        else:
+            current = self.pi.wave_tx_at()
+            if current not in [w[0] for w in self._waves]:
+                return
+        while self._waves and self._waves[0][0] != current:
+            self.pi.wave_delete(self._waves.popleft()[0])
+
+    def finish(self):
+        self._active = False
+
+    @property
+    def idle(self):
+        return not self.pi.wave_tx_busy()
+
+    def wait(self):
+        """
+        Blocks until all waves are sent, and updates the motor
+        positions of the plotter.
+        """
+        while not self.idle:
+            time.sleep(.001)
+        self._retire()
+        self._sync()
+
+    def _sync(self):
+        self.plotter.m1.abs_steps += self._pending[0]
+        self.plotter.m2.abs_steps += self._pending[1]
+        self._pending[:] = 0
+
+    def stats(self, reset=True):
+        """
+        Returns the number of steps and the underrun and backpressure
+        counters since the last reset. The step timing itself is done
+        by the hardware.
+        """
+        result = {'steps': self.steps,
+                  'underruns': self.underruns,
+                  'backpressure': self.backpressure}
+        if reset:
+            self._reset_stats()
+        return result
+
+    def close(self):
+        """
+        Stops the waves being sent, and updates the motor positions
+        with the steps that were made, going by the expected timing of
+        the interrupted wave.
+        """
+        self._retire()
+        self.pi.wave_tx_stop()
+        now = clock()
+        for wid, start, times, steps in self._waves:
+            if not len(steps):
+                continue
+            done = np.searchsorted(times, (now - start) * 1e6, 'right')
+            made = steps[done - 1] if done else 0
+            self._pending -= steps[-1] - made
+        self._waves.clear()
+        self.pi.wave_clear()
+        self._sync()
@@ -0,0 +1,128 @@
+import numpy as np
+
+
+class Waveform(object):
+    """
+    Compact representation of a prepared motor waveform. Steps are
+    stored as runs of identical steps, each with the delay before every
+    step in integer ticks, a bit field and a repeat count:
+        bit 0: left motor (else right motor)
+        bit 1: positive direction (lengthening the string)
+    Long runs of equal delays, as when a single motor moves steadily,
+    then take a single entry of 7 bytes.
+    """
+
+    dtype = np.dtype([('delay', '<u4'), ('bits', 'u1'), ('count', '<u2')])
+    LEFT = 1
+    POSITIVE = 2
+
+    def __init__(self, runs=None, tick=1e-6):
+        """
+        runs: Structured array of Waveform.dtype.
+        tick: Duration of one delay tick in seconds.
+        """
+        if runs is None:
+            runs = np.zeros(0, dtype=self.dtype)
+        self.runs = np.asarray(runs, dtype=self.dtype)
+        self.tick = float(tick)
+
+    @classmethod
+    def from_arrays(cls, delays, isleft, direction, tick=1e-6):
+        """
+        Packs the delays, isleft and direction arrays returned by the
+        step solver. Step times are rounded to whole ticks, so that the
+        rounding errors don't add up along the waveform.
+        """
+        delays = np.asarray(delays, dtype=np.float64)
+        n = len(delays)
+        if n == 0:
+            return cls(tick=tick)
+        times = np.round(np.cumsum(delays) / tick).astype(np.int64)
+        ticks = np.diff(np.hstack(([0], times)))
+        bits = np.asarray(isleft, dtype=np.uint8) * cls.LEFT + \
+            (np.asarray(direction) > 0).astype(np.uint8) * cls.POSITIVE
+
+        # run-length encoding of equal consecutive steps
+        change = np.ones(n, dtype=bool)
+        change[1:] = (ticks[1:] != ticks[:-1]) | (bits[1:] != bits[:-1])
+        starts = np.nonzero(change)[0]
+        counts = np.diff(np.hstack((starts, [n])))
+
+        # split runs which are too long for the count field
+        limit = np.iinfo(cls.dtype['count']).max
+        parts = (counts - 1) // limit + 1
+        index = np.repeat(np.arange(len(starts)), parts)
+        offset = np.arange(len(index)) - np.repeat(np.cumsum(parts) - parts,
+                                                  parts)
+
+        runs = np.zeros(len(index), dtype=cls.dtype)
+        runs['delay'] = ticks[starts][index]
+        runs['bits'] = bits[starts][index]
+        runs['count'] = np.minimum(counts[index] - offset * limit, limit)
+        return cls(runs, tick)
+
+    @classmethod
+    def concatenate(cls, waveforms):
+        """
+        Joins a sequence of waveforms, which must share the same tick.
+        """
+        waveforms = list(waveforms)
+        if not waveforms:
+            return cls()
+        tick = waveforms[0].tick
+        if any(w.tick != tick for w in waveforms):
+            raise ValueError('Waveforms with different ticks')
+        return cls(np.hstack([w.runs for w in waveforms]), tick)
+
+    def to_arrays(self):
+        """
+        Returns the delays (in seconds), isleft and direction arrays
+        of the individual steps.
+        """
+        counts = self.runs['count']
+        delays = np.repeat(self.runs['delay'], counts) * self.tick
+        bits = np.repeat(self.runs['bits'], counts)
+        isleft = (bits & self.LEFT).astype(bool)
+        direction = np.where(bits & self.POSITIVE, 1, -1).astype(np.int8)
+        return delays, isleft, direction
+
+    def steps(self):
+        """
+        Generates (delay, isleft, direction) for every step, without
+        unpacking the whole waveform.
+        """
+        for delay, bits, count in self.runs.tolist():
+            delay = delay * self.tick
+            isleft = bool(bits & self.LEFT)
+            direction = 1 if bits & self.POSITIVE else -1
+            for i in xrange(count):
+                yield delay, isleft, direction
+
+    def __len__(self):
+        return int(np.sum(self.runs['count'], dtype=np.int64))
+
+    @property
+    def duration(self):
+        """
+        Total duration in seconds.
+        """
+        return np.sum(self.runs['delay'].astype(np.int64) *
+                      self.runs['count']) * self.tick
+
+    @property
+    def nbytes(self):
+        return self.runs.nbytes
+
+    def save(self, fn):
+        """
+        Saves the waveform to a file name or file object, in npz format.
+        """
+        np.savez(fn, runs=self.runs, tick=self.tick)
+
+    @classmethod
+    def load(cls, fn):
+        """
+        Loads a waveform saved with save().
+        """
+        with np.load(fn) as data:
+            return cls(data['runs'], float(data['tick']))
@@ -0,0 +1,147 @@
+import os
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+from .Waveform import Waveform
+
+
+class WaveformCache(object):
+    """
+    Disk-backed cache of prepared Waveforms, so that replotting a job,
+    or paths shared between jobs, doesn't have to solve the step times
+    again. Waveforms are stored as one .npz file per key, and the least
+    recently used files are removed when the total size exceeds
+    max_bytes.
+
+    The total size is counted when the cache is first written to, and
+    kept up to date by put(), so the directory is only scanned again
+    when it has to be evicted.
+    """
+
+    # bump when the waveform format or the solver changes
+    version = 3
+
+    # temporary files older than this (in seconds) are left over from
+    # interrupted writes
+    stale_age = 3600
+
+    def __init__(self, directory=None, max_bytes=500e6):
+        """
+        directory:  Where to keep the waveforms.
+                    Default: ~/.cache/plotter/waveforms
+        max_bytes:  Total size of the cache on disk.
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                     'plotter', 'waveforms')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._total = None
+
+    def key(self, path, velocity, L, per_step, options=()):
+        """
+        Returns the hash of everything a waveform depends on: the path
+        coordinates, the velocity, the motor separation L, the per_step
+        calibrations (a number or a sequence) and any further numerical
+        options, such as velocity planning.
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(path, dtype=np.float64).tobytes())
+        params = [self.version, velocity, L] + list(np.ravel(per_step)) \
+            + list(options)
+        h.update(repr([float(p) for p in params]).encode())
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the Waveform stored under key, or None if there is
+        none.
+        """
+        fn = self._filename(key)
+        try:
+            waveform = Waveform.load(fn)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(fn, None)
+        except OSError:
+            pass
+        return waveform
+
+    def put(self, key, waveform):
+        """
+        Stores a waveform under key and evicts old ones if needed.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if self._total is None:
+            self._total = sum(e[1] for e in self._scan())
+        # write to a temporary file first, so that readers never see a
+        # partly written waveform
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as fp:
+            waveform.save(fp)
+        fn = self._filename(key)
+        try:
+            # replacing an existing waveform
+            self._total -= os.path.getsize(fn)
+        except OSError:
+            pass
+        os.rename(tmp, fn)
+        self._total += os.path.getsize(fn)
+        if self._total > self.max_bytes:
+            self._evict()
+
+    def _scan(self):
+        """
+        Returns (mtime, size, filename) of the cached waveforms, and
+        removes temporary files left over from interrupted writes.
+        """
+        entries = []
+        now = time.time()
+        for fn in os.listdir(self.directory):
+            path = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(path)
+                if fn.endswith('.tmp') and now - st.st_mtime > self.stale_age:
+                    os.remove(path)
+            except OSError:
+                continue
+            if fn.endswith('.npz'):
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        """
+        Removes the least recently used waveforms until the cache fits
+        in 80% of max_bytes, so that the following puts don't have to
+        scan the directory again right away.
+        """
+        entries = self._scan()
+        total = sum(e[1] for e in entries)
+        for mtime, size, fn in sorted(entries):
+            if total <= .8 * self.max_bytes:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
+        self._total = total
+
+    def clear(self):
+        """
+        Removes all cached waveforms.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for fn in os.listdir(self.directory):
+            if fn.endswith('.npz'):
+                os.remove(os.path.join(self.directory, fn))
+        self._total = 0
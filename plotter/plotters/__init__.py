@@ -1,2 +1,7 @@
 from MiniPlotter import MiniPlotter
 from BigVPlotter import BigVPlotter, SmallVPlotter
+from Waveform import Waveform
+from WaveformCache import WaveformCache
+from StepperProcess import StepperProcess
+from WaveStepper import WaveStepper
+from VelocityPlanner import VelocityPlanner